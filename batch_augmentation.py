@@ -0,0 +1,218 @@
+# Data augmentations that are applied to whole batches, after the data loader has collated them.
+# Applying augmentations per sample inside the dataset (in numpy and in the loader workers) has a lot of
+# python overhead when the patches are small. Here, we apply them to the batch tensors in one go:
+# - random flips and rotations by 90 degrees
+# - random affine (rotation, scaling) and elastic deformations, implemented with 'grid_sample'
+# - standardization and random intensity changes
+# The same geometric transformation is applied to the images and the labels of a sample.
+# The augmentations work for 2D (B, C, H, W) and 3D (B, C, D, H, W) batches.
+import math
+
+import torch
+import torch.nn.functional as F
+
+
+# Use this as 'raw_transform' in the torch_em loaders if the standardization is done by 'BatchAugmentation'.
+# (We use a function instead of a lambda so that the loader can be pickled.)
+def to_float32(raw):
+    return raw.astype("float32")
+
+
+# Use this as 'transform' in the torch_em loaders to disable the default per-sample augmentations.
+def no_augmentation(raw, labels):
+    return raw, labels
+
+
+# Standardize each sample of the batch to zero mean and unit standard deviation.
+# This corresponds to 'torch_em.transform.raw.standardize', applied per sample.
+def standardize_batch(x, eps=1e-7):
+    axes = tuple(range(1, x.dim()))
+    mean = x.mean(dim=axes, keepdim=True)
+    std = x.std(dim=axes, keepdim=True)
+    return (x - mean) / std.clamp(min=eps)
+
+
+def _sample_mask(batch_size, probability, device, ndim):
+    mask = torch.rand(batch_size, device=device) < probability
+    return mask.view((batch_size,) + (1,) * (ndim + 1))
+
+
+class BatchAugmentation:
+    """Random augmentations for batches of images and labels.
+
+    :param flip: whether to apply random flips along the spatial axes.
+    :param rot90: whether to apply random rotations by 90 degrees in the plane of the last two axes.
+        This is only applied if the last two axes have the same size.
+    :param affine: whether to apply random affine transformations (rotation and scaling).
+    :param elastic: whether to apply random elastic deformations.
+    :param standardize: whether to standardize the images per sample.
+    :param intensity_jitter: whether to apply random contrast and brightness changes to the images.
+    :param max_rotation: the maximal rotation angle in degrees for the affine transformation.
+    :param scale_range: the range of scale factors for the affine transformation.
+    :param elastic_alpha: the maximal displacement of the elastic deformation in pixels.
+    :param elastic_spacing: the spacing of the control points of the elastic deformation in pixels.
+    :param contrast: the maximal relative change of the contrast.
+    :param brightness: the maximal change of the brightness (relative to the standard deviation).
+    :param probability: the probability for applying the affine, elastic and intensity augmentations to a sample.
+    :param label_interpolation: the interpolation mode for the labels, "nearest" or "bilinear".
+        Use "bilinear" only for continuous label representations, e.g. distance maps.
+        Note: the affine and elastic deformations resample the labels. This is fine for instance or semantic labels,
+        but it breaks or thickens thin structures, e.g. the boundaries computed by 'BoundaryTransform'.
+        If the labels are transformed in the data loader (via 'label_transform'), use only 'flip' and 'rot90',
+        which are exact, or apply the deformations to the instance labels before the label transform.
+    """
+    def __init__(
+        self,
+        flip=True,
+        rot90=True,
+        affine=False,
+        elastic=False,
+        standardize=True,
+        intensity_jitter=True,
+        max_rotation=30.0,
+        scale_range=(0.9, 1.1),
+        elastic_alpha=8.0,
+        elastic_spacing=32,
+        contrast=0.2,
+        brightness=0.2,
+        probability=0.5,
+        label_interpolation="nearest",
+    ):
+        self.flip = flip
+        self.rot90 = rot90
+        self.affine = affine
+        self.elastic = elastic
+        self.standardize = standardize
+        self.intensity_jitter = intensity_jitter
+        self.max_rotation = max_rotation
+        self.scale_range = scale_range
+        self.elastic_alpha = elastic_alpha
+        self.elastic_spacing = elastic_spacing
+        self.contrast = contrast
+        self.brightness = brightness
+        self.probability = probability
+        self.label_interpolation = label_interpolation
+
+    def _flip(self, x, y, ndim):
+        for axis in range(2, 2 + ndim):
+            mask = _sample_mask(x.shape[0], 0.5, x.device, ndim)
+            x = torch.where(mask, x.flip(axis), x)
+            y = torch.where(mask, y.flip(axis), y)
+        return x, y
+
+    def _rot90(self, x, y):
+        if x.shape[-1] != x.shape[-2]:
+            return x, y
+        x, y = x.clone(), y.clone()
+        ks = torch.randint(0, 4, (x.shape[0],), device=x.device)
+        for k in range(1, 4):
+            index = ks == k
+            if index.any():
+                x[index] = torch.rot90(x[index], k, dims=(-2, -1))
+                y[index] = torch.rot90(y[index], k, dims=(-2, -1))
+        return x, y
+
+    # Create the sampling grid for the affine and elastic deformations.
+    def _get_grid(self, x, ndim):
+        batch_size, spatial_shape = x.shape[0], x.shape[2:]
+        apply = torch.rand(batch_size, device=x.device) < self.probability
+
+        # The affine matrix rotates and scales in the plane of the last two axes.
+        theta = torch.zeros(batch_size, ndim, ndim + 1, device=x.device)
+        for i in range(ndim):
+            theta[:, i, i] = 1.0
+        if self.affine:
+            angle = (torch.rand(batch_size, device=x.device) * 2 - 1) * math.radians(self.max_rotation)
+            low, high = self.scale_range
+            scale = low + torch.rand(batch_size, device=x.device) * (high - low)
+            angle, scale = torch.where(apply, angle, 0.0), torch.where(apply, scale, 1.0)
+            # Note: the grid coordinates are in the order (x, y, z), i.e. reversed compared to the tensor axes.
+            theta[:, 0, 0] = scale * torch.cos(angle)
+            theta[:, 0, 1] = -scale * torch.sin(angle)
+            theta[:, 1, 0] = scale * torch.sin(angle)
+            theta[:, 1, 1] = scale * torch.cos(angle)
+        grid = F.affine_grid(theta, size=x.shape, align_corners=False)
+
+        # The elastic deformation is a random displacement on a coarse grid that is upsampled to the full shape.
+        if self.elastic:
+            coarse_shape = tuple(max(2, sh // self.elastic_spacing) for sh in spatial_shape)
+            displacement = torch.rand((batch_size, ndim) + coarse_shape, device=x.device) * 2 - 1
+            mode = "bilinear" if ndim == 2 else "trilinear"
+            displacement = F.interpolate(displacement, size=spatial_shape, mode=mode, align_corners=True)
+            # Convert from pixels to the normalized coordinates of the grid and zero it for samples without deformation.
+            normalization = torch.tensor([2.0 / sh for sh in spatial_shape], device=x.device)
+            displacement = displacement * (self.elastic_alpha * normalization).view((1, ndim) + (1,) * ndim)
+            displacement = displacement * apply.view((batch_size,) + (1,) * (ndim + 1))
+            grid = grid + displacement.movedim(1, -1).flip(-1)
+
+        return grid
+
+    def _warp(self, x, y, ndim):
+        grid = self._get_grid(x, ndim)
+        x = F.grid_sample(x, grid, mode="bilinear", padding_mode="reflection", align_corners=False)
+        label_dtype = y.dtype
+        y = F.grid_sample(
+            y.float(), grid, mode=self.label_interpolation, padding_mode="reflection", align_corners=False
+        )
+        return x, y.to(label_dtype)
+
+    def _intensity_jitter(self, x, ndim):
+        shape = (x.shape[0], x.shape[1]) + (1,) * ndim
+        apply = _sample_mask(x.shape[0], self.probability, x.device, ndim)
+        contrast = 1.0 + (torch.rand(shape, device=x.device) * 2 - 1) * self.contrast
+        brightness = (torch.rand(shape, device=x.device) * 2 - 1) * self.brightness
+        return torch.where(apply, x * contrast + brightness, x)
+
+    def __call__(self, x, y):
+        ndim = x.dim() - 2
+        assert ndim in (2, 3), f"Expected a 2D or 3D batch, got a tensor of shape {x.shape}"
+        assert x.shape[0] == y.shape[0] and x.shape[2:] == y.shape[2:], f"{x.shape}, {y.shape}"
+        x = x.float()
+
+        if self.flip:
+            x, y = self._flip(x, y, ndim)
+        if self.rot90:
+            x, y = self._rot90(x, y)
+        if self.affine or self.elastic:
+            x, y = self._warp(x, y, ndim)
+        # We apply the intensity changes after the standardization, otherwise the standardization would undo them.
+        if self.standardize:
+            x = standardize_batch(x)
+        if self.intensity_jitter:
+            x = self._intensity_jitter(x, ndim)
+
+        return x, y
+
+
+class BatchAugmentationLoader:
+    """Wrap a data loader to apply augmentations to each batch.
+
+    This works for the torch_em loaders as well as for a 'torch.utils.data.DataLoader'.
+    All other attributes (e.g. 'dataset' or 'batch_size') are forwarded to the wrapped loader.
+
+    :param loader: the data loader.
+    :param augmentation: the augmentation, called as 'augmentation(x, y)' for each batch, e.g. 'BatchAugmentation'.
+    :param device: the device for applying the augmentations. By default they are applied on the device of the batch.
+    """
+    def __init__(self, loader, augmentation, device=None):
+        self.loader = loader
+        self.augmentation = augmentation
+        self.device = device
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        for x, y in self.loader:
+            if self.device is not None:
+                x, y = x.to(self.device, non_blocking=True), y.to(self.device, non_blocking=True)
+            # Note: we must not yield inside of 'no_grad', otherwise gradients would be disabled for the training step.
+            with torch.no_grad():
+                x, y = self.augmentation(x, y)
+            yield x, y
+
+    def __getattr__(self, name):
+        # The 'loader' attribute is not set yet when the wrapper is unpickled (e.g. in a data loader worker).
+        if name == "loader":
+            raise AttributeError(name)
+        return getattr(self.loader, name)
@@ -0,0 +1,137 @@
+# A store for the small cell images (crops) used for training the infection classifier.
+# Instead of keeping crops of different shapes in python lists and resizing them each time they are loaded,
+# we resize all crops of a split once and write them into a single contiguous array of shape (N, C, H, W).
+# The array is stored in a binary file and opened as a memory map, so that the dataset can return views into it
+# without copying or resizing. The labels and the provenance (sample name and cell id) of each crop are stored as well.
+import json
+import os
+
+import numpy as np
+from skimage.transform import resize
+from torch.utils.data import Dataset
+from tqdm import tqdm
+
+IMAGE_FILE = "images.bin"
+LABEL_FILE = "labels.json"
+METADATA_FILE = "metadata.json"
+
+
+# Check if a crop store exists at 'path' that was built with the same settings.
+def crop_store_exists(path, target_size, sample_names=None):
+    metadata_path = os.path.join(path, METADATA_FILE)
+    if not os.path.exists(metadata_path):
+        return False
+    with open(metadata_path, "r") as f:
+        metadata = json.load(f)
+    if tuple(metadata["shape"][1:]) != tuple(target_size):
+        return False
+    # Stores that were built without the original crop shapes are rebuilt.
+    with open(os.path.join(path, LABEL_FILE), "r") as f:
+        if "original_shapes" not in json.load(f):
+            return False
+    return sample_names is None or sorted(metadata["sample_names"]) == sorted(sample_names)
+
+
+def build_crop_store(path, sample_folders, extract_function, target_size, overwrite=False):
+    """Write the resized crops for all samples into a contiguous array.
+
+    :param path: the folder for the crop store.
+    :param sample_folders: the folders with the data for each sample (e.g. all folders of the training split).
+    :param extract_function: the function for extracting the crops from a sample folder. It must return
+        the crops, the labels and the cell ids, e.g. 'extract_images_and_labels(folder, return_cell_ids=True)'.
+    :param target_size: the shape (C, H, W) the crops are resized to.
+    :param overwrite: whether to overwrite an existing crop store. By default an existing store with the same
+        settings is re-used.
+    :returns: the number of crops in the store.
+    """
+    sample_names = [os.path.basename(folder) for folder in sample_folders]
+    if not overwrite and crop_store_exists(path, target_size, sample_names):
+        with open(os.path.join(path, METADATA_FILE), "r") as f:
+            return json.load(f)["shape"][0]
+
+    os.makedirs(path, exist_ok=True)
+    metadata_path = os.path.join(path, METADATA_FILE)
+    if os.path.exists(metadata_path):
+        os.remove(metadata_path)
+
+    labels, provenance, original_shapes = [], [], []
+    # We append the crops one sample after the other to the binary file,
+    # so that we only keep the crops of a single sample in memory.
+    with open(os.path.join(path, IMAGE_FILE), "wb") as f:
+        for folder, sample_name in tqdm(zip(sample_folders, sample_names), total=len(sample_folders)):
+            crops, crop_labels, cell_ids = extract_function(folder)
+            assert len(crops) == len(crop_labels) == len(cell_ids)
+            for crop, label, cell_id in zip(crops, crop_labels, cell_ids):
+                # We resize the same way as the 'CustomDataset' in the notebook, but store float32.
+                resized = resize(crop, target_size, preserve_range=True).astype("float32")
+                f.write(np.ascontiguousarray(resized).tobytes())
+                labels.append(int(label))
+                provenance.append([sample_name, int(cell_id)])
+                original_shapes.append(list(crop.shape))
+
+    with open(os.path.join(path, LABEL_FILE), "w") as f:
+        json.dump({"labels": labels, "provenance": provenance, "original_shapes": original_shapes}, f)
+    # We write the metadata last, so that an interrupted build is not mistaken for a complete store.
+    metadata = {"shape": [len(labels)] + list(target_size), "dtype": "float32", "sample_names": sample_names}
+    with open(metadata_path, "w") as f:
+        json.dump(metadata, f)
+    return len(labels)
+
+
+def load_crop_store(path):
+    """Load the crop store.
+
+    :param path: the folder of the crop store.
+    :returns:
+        - images - the memory mapped crops, with shape (N, C, H, W)
+        - labels - the labels of the crops
+        - provenance - the sample name and cell id for each crop
+    """
+    with open(os.path.join(path, METADATA_FILE), "r") as f:
+        metadata = json.load(f)
+    with open(os.path.join(path, LABEL_FILE), "r") as f:
+        label_data = json.load(f)
+    # We use the copy-on-write mode, so that the array is writable (which avoids a warning in torch.from_numpy),
+    # but the data on disk is never changed.
+    # An empty file can't be memory mapped, so we return an empty array if the store does not contain any crops.
+    if metadata["shape"][0] == 0:
+        images = np.zeros(tuple(metadata["shape"]), dtype=metadata["dtype"])
+    else:
+        images = np.memmap(
+            os.path.join(path, IMAGE_FILE), dtype=metadata["dtype"], mode="c", shape=tuple(metadata["shape"])
+        )
+    labels = np.array(label_data["labels"], dtype="int64")
+    provenance = [tuple(prov) for prov in label_data["provenance"]]
+    return images, labels, provenance
+
+
+def load_original_shapes(path):
+    """Load the shapes of the crops before they were resized, with shape (N, ndim)."""
+    with open(os.path.join(path, METADATA_FILE), "r") as f:
+        ndim = len(json.load(f)["shape"]) - 1
+    with open(os.path.join(path, LABEL_FILE), "r") as f:
+        label_data = json.load(f)
+    if "original_shapes" not in label_data:
+        raise RuntimeError(
+            f"The crop store at {path} does not contain the original shapes. Rebuild it with 'overwrite=True'."
+        )
+    return np.array(label_data["original_shapes"], dtype="int64").reshape(-1, ndim)
+
+
+class CropStoreDataset(Dataset):
+    """PyTorch dataset for the crops in a crop store.
+
+    :param path: the folder of the crop store.
+    :param label_offset: the value subtracted from the labels, so that the classes start at 0.
+    """
+    def __init__(self, path, label_offset=1):
+        self.images, self.labels, self.provenance = load_crop_store(path)
+        self.label_offset = label_offset
+
+    def __len__(self):
+        return len(self.labels)
+
+    # The image is a view into the memory map, so no data is copied or resized here.
+    # Like in the 'CustomDataset' we subtract 1 from the labels (1 -> 0 = infected, 2 -> 1 = not infected).
+    def __getitem__(self, index):
+        return np.asarray(self.images[index]), self.labels[index] - self.label_offset
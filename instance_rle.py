@@ -0,0 +1,231 @@
+# Compact storage of instance segmentations (label images) as per-object run-length encodings (RLE).
+# Label images (e.g. the cell and nucleus labels from 'utils.prepare_data', annotations from micro_sam
+# or watershed results) are mostly background and often stored as int64 or uint32. Here, we store each object
+# as the run-length encoding of its mask within its bounding box. This is much smaller than the dense
+# label image, and each object can be decoded individually, without decoding the whole image.
+# The run-length encoding follows the COCO convention: the mask is flattened in column-major (Fortran) order
+# and the counts alternate between background and foreground, starting with background.
+# Objects can be exported as COCO annotations with 'to_coco_annotations' (only for 2D).
+# You can run it from the command line via: python instance_rle.py labels.tif labels_rle.h5
+import json
+
+import numpy as np
+from scipy.ndimage import find_objects
+
+
+# Run-length encode a binary mask, flattened in column-major order.
+def encode_mask(mask):
+    flat = np.asarray(mask, dtype=bool).ravel(order="F")
+    if flat.size == 0:
+        return np.zeros(0, dtype="uint32")
+    # Find the positions where the value changes; the runs are between these positions.
+    changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    boundaries = np.concatenate([[0], changes, [flat.size]])
+    counts = np.diff(boundaries)
+    # The counts start with background by convention, so we add an empty background run if needed.
+    if flat[0]:
+        counts = np.concatenate([[0], counts])
+    return counts.astype("uint32")
+
+
+# Decode the run-length encoding of a binary mask with the given shape.
+def decode_mask(counts, shape):
+    values = np.arange(len(counts)) % 2 == 1
+    flat = np.repeat(values, counts)
+    return flat.reshape(shape, order="F")
+
+
+def _bbox_to_slices(bbox):
+    ndim = len(bbox) // 2
+    return tuple(slice(int(start), int(stop)) for start, stop in zip(bbox[:ndim], bbox[ndim:]))
+
+
+class InstanceRLE:
+    """Run-length encoded instance segmentation.
+
+    :param shape: the shape of the label image.
+    :param ids: the ids of the objects.
+    :param bboxes: the bounding boxes of the objects, in the format (start_0, ..., start_n, stop_0, ..., stop_n)
+        (the same format as 'regionprops(...).bbox').
+    :param counts: the concatenated run-length encodings of all objects.
+    :param offsets: the start of the encoding of each object in 'counts' (with the total length as last entry).
+    :param dtype: the data type of the label image.
+    """
+    def __init__(self, shape, ids, bboxes, counts, offsets, dtype="uint32"):
+        self.shape = tuple(int(sh) for sh in shape)
+        self.ids = np.asarray(ids)
+        self.bboxes = np.asarray(bboxes, dtype="int64").reshape(len(self.ids), 2 * len(self.shape))
+        self.counts = np.asarray(counts, dtype="uint32")
+        self.offsets = np.asarray(offsets, dtype="int64")
+        self.dtype = np.dtype(dtype)
+        self._index = {int(label_id): i for i, label_id in enumerate(self.ids)}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, label_id):
+        return int(label_id) in self._index
+
+    def get_bbox(self, label_id):
+        """Get the bounding box of an object as a tuple of slices."""
+        return _bbox_to_slices(self.bboxes[self._index[int(label_id)]])
+
+    def get_object(self, label_id):
+        """Decode a single object.
+
+        :param label_id: the id of the object.
+        :returns:
+            - bbox - the bounding box of the object as a tuple of slices
+            - mask - the binary mask of the object within the bounding box
+        """
+        i = self._index[int(label_id)]
+        bbox = _bbox_to_slices(self.bboxes[i])
+        mask_shape = tuple(bb.stop - bb.start for bb in bbox)
+        return bbox, decode_mask(self.counts[self.offsets[i]:self.offsets[i + 1]], mask_shape)
+
+    def decode(self, label_ids=None):
+        """Decode the label image, or only the objects with the given ids."""
+        labels = np.zeros(self.shape, dtype=self.dtype)
+        for label_id in (self.ids if label_ids is None else label_ids):
+            bbox, mask = self.get_object(label_id)
+            labels[bbox][mask] = label_id
+        return labels
+
+    def to_coco_annotations(self, image_id=0, category_id=1, start_annotation_id=1):
+        """Convert the objects to COCO annotations with uncompressed RLE segmentation.
+
+        This is only supported for 2D label images.
+        The annotations can be converted to the compressed COCO RLE with 'pycocotools.mask.frPyObjects'.
+        """
+        if len(self.shape) != 2:
+            raise ValueError("COCO annotations are only supported for 2D label images.")
+        height = self.shape[0]
+        annotations = []
+        for annotation_id, label_id in enumerate(self.ids, start=start_annotation_id):
+            bbox, mask = self.get_object(label_id)
+            # Map the foreground pixels of the mask in the bounding box to the column-major index in the full image.
+            # (Transposing the mask gives the pixels in column-major order.)
+            ys, xs = np.nonzero(mask.T)[::-1]
+            indices = (xs + bbox[1].start) * height + (ys + bbox[0].start)
+            # Find the foreground runs: consecutive indices belong to the same run.
+            breaks = np.flatnonzero(np.diff(indices) != 1) + 1
+            run_starts = indices[np.concatenate([[0], breaks])]
+            run_stops = indices[np.concatenate([breaks - 1, [len(indices) - 1]])] + 1
+            # Interleave the background runs (between the foreground runs) and the foreground runs.
+            background = run_starts - np.concatenate([[0], run_stops[:-1]])
+            foreground = run_stops - run_starts
+            counts = np.stack([background, foreground], axis=1).ravel()
+            counts = np.concatenate([counts, [self.shape[0] * self.shape[1] - run_stops[-1]]])
+            annotations.append({
+                "id": annotation_id,
+                "image_id": image_id,
+                "category_id": category_id,
+                "segmentation": {"size": list(self.shape), "counts": counts.tolist()},
+                "area": int(mask.sum()),
+                # COCO bounding boxes have the format (x, y, width, height).
+                "bbox": [bbox[1].start, bbox[0].start, bbox[1].stop - bbox[1].start, bbox[0].stop - bbox[0].start],
+                "iscrowd": 0,
+                "label_id": int(label_id),
+            })
+        return annotations
+
+
+def encode_labels(labels):
+    """Run-length encode all objects in a label image.
+
+    :param labels: the label image (2D or 3D). Zero is treated as background.
+    :returns: the encoded label image (InstanceRLE).
+    """
+    labels = np.asarray(labels)
+    ids, bboxes, all_counts = [], [], []
+    # 'find_objects' finds the bounding boxes of all objects in a single pass over the image.
+    # It needs non-negative integer labels, so we don't support negative ids.
+    for label_id, bbox in enumerate(find_objects(labels), start=1):
+        if bbox is None:
+            continue
+        ids.append(label_id)
+        bboxes.append([bb.start for bb in bbox] + [bb.stop for bb in bbox])
+        all_counts.append(encode_mask(labels[bbox] == label_id))
+    offsets = np.concatenate([[0], np.cumsum([len(counts) for counts in all_counts])]).astype("int64")
+    counts = np.concatenate(all_counts) if all_counts else np.zeros(0, dtype="uint32")
+    return InstanceRLE(labels.shape, ids, bboxes, counts, offsets, dtype=labels.dtype)
+
+
+def write_rle(path, rle, key="labels"):
+    """Write the encoded label image to an hdf5 file."""
+    import h5py
+    with h5py.File(path, "a") as f:
+        if key in f:
+            del f[key]
+        g = f.create_group(key)
+        g.attrs["shape"] = list(rle.shape)
+        g.attrs["dtype"] = str(rle.dtype)
+        g.create_dataset("ids", data=rle.ids)
+        g.create_dataset("bboxes", data=rle.bboxes)
+        g.create_dataset("offsets", data=rle.offsets)
+        g.create_dataset("counts", data=rle.counts, chunks=True if len(rle.counts) else None, compression="gzip")
+
+
+def read_rle(path, key="labels"):
+    """Read the encoded label image from an hdf5 file."""
+    import h5py
+    with h5py.File(path, "r") as f:
+        g = f[key]
+        return InstanceRLE(
+            g.attrs["shape"], g["ids"][:], g["bboxes"][:], g["counts"][:], g["offsets"][:], dtype=g.attrs["dtype"]
+        )
+
+
+def read_object(path, label_id, key="labels"):
+    """Read and decode a single object from an hdf5 file, without loading the other objects.
+
+    :returns:
+        - bbox - the bounding box of the object as a tuple of slices
+        - mask - the binary mask of the object within the bounding box
+    """
+    import h5py
+    with h5py.File(path, "r") as f:
+        g = f[key]
+        index = np.flatnonzero(g["ids"][:] == label_id)
+        if len(index) == 0:
+            raise KeyError(label_id)
+        i = int(index[0])
+        bbox = _bbox_to_slices(g["bboxes"][i])
+        start, stop = g["offsets"][i:i + 2]
+        counts = g["counts"][start:stop]
+    mask_shape = tuple(bb.stop - bb.start for bb in bbox)
+    return bbox, decode_mask(counts, mask_shape)
+
+
+def write_coco(path, rle, image_id=0, file_name=None, category_name="cell"):
+    """Write the encoded label image as a COCO json file (only for 2D)."""
+    annotations = rle.to_coco_annotations(image_id=image_id)
+    image = {"id": image_id, "height": rle.shape[0], "width": rle.shape[1]}
+    if file_name is not None:
+        image["file_name"] = file_name
+    coco = {
+        "images": [image],
+        "annotations": annotations,
+        "categories": [{"id": 1, "name": category_name}],
+    }
+    with open(path, "w") as f:
+        json.dump(coco, f)
+
+
+def main(args=None):
+    import argparse
+    import imageio.v3 as imageio
+    parser = argparse.ArgumentParser(description="Run-length encode the objects in a label image.")
+    parser.add_argument("input_path", help="The label image, e.g. a tif file.")
+    parser.add_argument("output_path", help="The output file: an hdf5 file (.h5) or a COCO json file (.json).")
+    parser.add_argument("-k", "--key", default="labels", help="The name of the group in the hdf5 file.")
+    args = parser.parse_args(args)
+    rle = encode_labels(imageio.imread(args.input_path))
+    if args.output_path.endswith(".json"):
+        write_coco(args.output_path, rle, file_name=args.input_path)
+    else:
+        write_rle(args.output_path, rle, key=args.key)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,258 @@
+# Global intensity statistics for normalizing images consistently.
+# If each tile (for tiled prediction) or each patch (for training) is normalized with its own mean and standard
+# deviation, the normalization differs between tiles, which can lead to visible seams in the prediction.
+# Here, we compute the statistics (mean, standard deviation, min, max and percentiles) once for the whole image
+# or dataset, in a streaming pass over blocks of the data (two passes for floating point data), so that it never
+# has to be fully loaded.
+# The percentiles are computed from a histogram: exactly for integer data (one bin per value) and approximately
+# for floating point data. The statistics are stored with the data (as attribute for hdf5 files, otherwise
+# in a json file next to the data) and can then be used for normalization via 'GlobalNormalization'.
+# For a trained model, the statistics of the training data are stored in the checkpoint folder
+# ('write_model_statistics'), so that the same normalization can be used for prediction ('read_model_statistics').
+import json
+import os
+from itertools import product
+
+import numpy as np
+
+DEFAULT_PERCENTILES = (0.1, 1.0, 5.0, 50.0, 95.0, 99.0, 99.9)
+STATISTICS_ATTRIBUTE = "intensity_statistics"
+MODEL_STATISTICS_FILE = "intensity_statistics.json"
+
+
+# The default block shape: 512 x 512 in-plane and 32 slices for 3D data, so that a block (and its float64 copy)
+# stays small. Additional leading axes (e.g. channels) are processed one by one.
+def _default_block_shape(ndim):
+    if ndim < 3:
+        return (512,) * ndim
+    return (1,) * (ndim - 3) + (32, 512, 512)
+
+
+def _iterate_blocks(data, block_shape):
+    if block_shape is None:
+        block_shape = _default_block_shape(data.ndim)
+    elif len(block_shape) >= data.ndim:
+        block_shape = tuple(block_shape[-data.ndim:])
+    else:
+        # The block shape is given for the last axes, we use the default for the other axes.
+        block_shape = _default_block_shape(data.ndim)[:data.ndim - len(block_shape)] + tuple(block_shape)
+    for start in product(*(range(0, sh, bs) for sh, bs in zip(data.shape, block_shape))):
+        bb = tuple(slice(st, min(st + bs, sh)) for st, bs, sh in zip(start, block_shape, data.shape))
+        yield np.asarray(data[bb])
+
+
+class _StatisticsAccumulator:
+    def __init__(self, dtype, value_range=None, n_bins=4096):
+        self.count = 0
+        self.sum = 0.0
+        self.sum_squares = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+        # For integer data with at most 16 bits we use one histogram bin per value, so the percentiles are exact.
+        self.exact = np.issubdtype(dtype, np.integer) and np.dtype(dtype).itemsize <= 2
+        if self.exact:
+            info = np.iinfo(dtype)
+            self.offset = int(info.min)
+            self.histogram = np.zeros(int(info.max) - int(info.min) + 1, dtype="int64")
+        else:
+            self.bin_edges = np.linspace(value_range[0], value_range[1], n_bins + 1)
+            self.histogram = np.zeros(n_bins, dtype="int64")
+
+    def update(self, block):
+        block = block.ravel()
+        if block.size == 0:
+            return
+        self.count += block.size
+        block_float = block.astype("float64")
+        self.sum += block_float.sum()
+        self.sum_squares += np.square(block_float).sum()
+        self.min = min(self.min, block.min())
+        self.max = max(self.max, block.max())
+        if self.exact:
+            self.histogram += np.bincount(block.astype("int64") - self.offset, minlength=len(self.histogram))
+        else:
+            self.histogram += np.histogram(block, bins=self.bin_edges)[0]
+
+    def _percentile(self, q):
+        cumulative = np.cumsum(self.histogram)
+        target = q / 100.0 * self.count
+        index = min(int(np.searchsorted(cumulative, target)), len(self.histogram) - 1)
+        if self.exact:
+            return float(index + self.offset)
+        # Interpolate linearly within the bin.
+        previous = cumulative[index - 1] if index > 0 else 0
+        fraction = (target - previous) / max(self.histogram[index], 1)
+        low, high = self.bin_edges[index], self.bin_edges[index + 1]
+        return float(low + np.clip(fraction, 0.0, 1.0) * (high - low))
+
+    def result(self, percentiles):
+        mean = self.sum / self.count
+        variance = max(self.sum_squares / self.count - mean ** 2, 0.0)
+        return {
+            "count": int(self.count),
+            "mean": float(mean),
+            "std": float(np.sqrt(variance)),
+            "min": float(self.min),
+            "max": float(self.max),
+            "percentiles": {str(float(q)): self._percentile(q) for q in percentiles},
+        }
+
+
+def compute_statistics(data, block_shape=None, percentiles=DEFAULT_PERCENTILES, n_bins=4096):
+    """Compute the intensity statistics of an image or dataset block by block.
+
+    :param data: the data: a numpy array, an hdf5 dataset or another array-like object,
+        or a list of them to compute the statistics over several images (e.g. all images of the training set).
+    :param block_shape: the shape of the blocks that are loaded at once. By default 512 x 512 in-plane
+        (and 32 slices for 3D data). If it has fewer axes than the data, it is used for the last axes.
+    :param percentiles: the percentiles to compute, in the range [0, 100].
+    :param n_bins: the number of histogram bins for floating point data.
+    :returns: dictionary with the statistics: 'count', 'mean', 'std', 'min', 'max' and 'percentiles'.
+    """
+    arrays = data if isinstance(data, (list, tuple)) else [data]
+    dtype = np.result_type(*[array.dtype for array in arrays])
+
+    # For floating point data we need the value range for the histogram, which requires an additional pass.
+    value_range = None
+    exact = np.issubdtype(dtype, np.integer) and np.dtype(dtype).itemsize <= 2
+    if not exact:
+        min_value, max_value = np.inf, -np.inf
+        for array in arrays:
+            for block in _iterate_blocks(array, block_shape):
+                if block.size > 0:
+                    min_value, max_value = min(min_value, block.min()), max(max_value, block.max())
+        value_range = (float(min_value), float(max_value) if max_value > min_value else float(min_value) + 1.0)
+
+    accumulator = _StatisticsAccumulator(dtype, value_range, n_bins)
+    for array in arrays:
+        for block in _iterate_blocks(array, block_shape):
+            accumulator.update(block)
+    return accumulator.result(percentiles)
+
+
+def _sidecar_path(path, key):
+    suffix = "" if key is None else "_" + key.strip("/").replace("/", "_")
+    return f"{os.path.splitext(path)[0]}{suffix}.stats.json"
+
+
+def _is_hdf5(path):
+    return os.path.splitext(path)[1].lower() in (".h5", ".hdf5", ".hdf")
+
+
+def write_statistics(path, statistics, key=None):
+    """Store the statistics with the data.
+
+    For hdf5 files they are stored as attribute of the dataset 'key', otherwise in a json file next to the data.
+    """
+    if _is_hdf5(path):
+        import h5py
+        with h5py.File(path, "a") as f:
+            f[key].attrs[STATISTICS_ATTRIBUTE] = json.dumps(statistics)
+    else:
+        with open(_sidecar_path(path, key), "w") as f:
+            json.dump(statistics, f)
+
+
+def read_statistics(path, key=None):
+    """Load the statistics stored with the data. Returns None if they have not been computed yet."""
+    if _is_hdf5(path):
+        import h5py
+        with h5py.File(path, "r") as f:
+            statistics = f[key].attrs.get(STATISTICS_ATTRIBUTE, None)
+        return None if statistics is None else json.loads(statistics)
+    sidecar_path = _sidecar_path(path, key)
+    if not os.path.exists(sidecar_path):
+        return None
+    with open(sidecar_path, "r") as f:
+        return json.load(f)
+
+
+def get_statistics(path, key=None, **kwargs):
+    """Load the statistics stored with the data, or compute and store them if they are not available.
+
+    :param path: the path to the data (hdf5 file or an image file that can be read by imageio).
+    :param key: the name of the dataset in the hdf5 file.
+    :param kwargs: additional arguments for 'compute_statistics'.
+    """
+    statistics = read_statistics(path, key)
+    if statistics is not None:
+        return statistics
+    if _is_hdf5(path):
+        import h5py
+        with h5py.File(path, "r") as f:
+            statistics = compute_statistics(f[key], **kwargs)
+    else:
+        import imageio.v3 as imageio
+        statistics = compute_statistics(imageio.imread(path), **kwargs)
+    write_statistics(path, statistics, key)
+    return statistics
+
+
+def compute_dataset_statistics(paths, key=None, **kwargs):
+    """Compute the statistics over several images, e.g. all images of the training set.
+
+    :param paths: the paths to the data (hdf5 files or image files that can be read by imageio).
+    :param key: the name of the dataset in the hdf5 files.
+    :param kwargs: additional arguments for 'compute_statistics'.
+    """
+    import h5py
+    import imageio.v3 as imageio
+    # The hdf5 datasets are read block by block, the other images are loaded into memory.
+    files = [h5py.File(path, "r") for path in paths if _is_hdf5(path)]
+    try:
+        data = [f[key] for f in files] + [imageio.imread(path) for path in paths if not _is_hdf5(path)]
+        return compute_statistics(data, **kwargs)
+    finally:
+        for f in files:
+            f.close()
+
+
+def write_model_statistics(checkpoint_folder, statistics):
+    """Store the statistics of the training data in the checkpoint folder of a model (e.g. checkpoints/{name})."""
+    os.makedirs(checkpoint_folder, exist_ok=True)
+    with open(os.path.join(checkpoint_folder, MODEL_STATISTICS_FILE), "w") as f:
+        json.dump(statistics, f)
+
+
+def read_model_statistics(checkpoint_folder):
+    """Load the statistics of the training data from the checkpoint folder of a model."""
+    path = os.path.join(checkpoint_folder, MODEL_STATISTICS_FILE)
+    if not os.path.exists(path):
+        raise FileNotFoundError(
+            f"Could not find the intensity statistics at {path}. "
+            "Train the model with 'use_global_normalization = True' to use the global normalization."
+        )
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+class GlobalNormalization:
+    """Normalize data with precomputed global statistics.
+
+    It can be used as 'raw_transform' for the torch_em data loaders and as 'preprocess' for 'predict_with_halo',
+    so that all patches or tiles are normalized in the same way.
+
+    :param statistics: the statistics, computed with 'compute_statistics' or 'get_statistics'.
+    :param mode: the normalization mode:
+        - "standardize": subtract the mean and divide by the standard deviation (like 'torch_em.transform.raw.standardize').
+        - "percentile": map the lower percentile to 0 and the upper percentile to 1
+            (like 'torch_em.transform.raw.normalize_percentile').
+    :param lower: the lower percentile for the "percentile" mode.
+    :param upper: the upper percentile for the "percentile" mode.
+    :param eps: small value to avoid division by zero.
+    """
+    def __init__(self, statistics, mode="standardize", lower=1.0, upper=99.0, eps=1e-7):
+        if mode not in ("standardize", "percentile"):
+            raise ValueError(f"Invalid normalization mode: {mode}")
+        if mode == "standardize":
+            self.offset, self.scale = statistics["mean"], statistics["std"]
+        else:
+            percentiles = statistics["percentiles"]
+            if str(float(lower)) not in percentiles or str(float(upper)) not in percentiles:
+                raise ValueError(f"The percentiles {lower} and {upper} were not computed, available: {list(percentiles)}")
+            self.offset = percentiles[str(float(lower))]
+            self.scale = percentiles[str(float(upper))] - self.offset
+        self.scale = max(self.scale, eps)
+
+    def __call__(self, data):
+        return (np.asarray(data, dtype="float32") - self.offset) / self.scale
@@ -0,0 +1,150 @@
+# Performance settings for training (and prediction) with torch_em on CPU.
+# The settings 'mixed_precision=True' and 'compile_model=False' that we use in the training scripts
+# are meant for GPUs. On a CPU they don't give a speed-up. Here, we implement a preset for CPUs instead:
+# - bfloat16 autocast, if the CPU supports it natively (otherwise it is emulated and slower than float32).
+# - channels-last memory format (channels_last_3d for 3D), which is faster for the oneDNN convolutions.
+# - number of threads matched to the available cores.
+# - (optionally) compilation of the model with torch.compile.
+import copy
+import os
+import time
+import types
+
+import torch
+
+
+# Check if the CPU supports bfloat16 natively (e.g. with AVX512-BF16 or AMX).
+def cpu_supports_bf16():
+    try:
+        return bool(torch.ops.mkldnn._is_mkldnn_bf16_supported())
+    except (AttributeError, RuntimeError):
+        return False
+
+
+# Get the number of cores that are available to this process.
+def get_available_cores():
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+# Set the number of threads used by pytorch.
+# By default we use all available cores for the operations (intra-op threads)
+# and few threads for running independent operations in parallel (inter-op threads).
+# If you use workers in the data loader you should reduce 'n_threads' accordingly.
+def set_cpu_threads(n_threads=None, n_interop_threads=None):
+    n_threads = get_available_cores() if n_threads is None else n_threads
+    n_interop_threads = min(4, n_threads) if n_interop_threads is None else n_interop_threads
+    torch.set_num_threads(n_threads)
+    # The number of inter-op threads can only be set once, before any parallel work has started.
+    try:
+        torch.set_num_interop_threads(n_interop_threads)
+    except RuntimeError:
+        pass
+    return n_threads, n_interop_threads
+
+
+# The forward pass of a model with the CPU preset: it runs in bfloat16 autocast and with channels-last inputs.
+# The autocast context manager is exited also if the forward pass fails and it is supported by torch.compile.
+# The output is cast back to float32, so that the loss is computed in full precision.
+def _cpu_forward(self, *args, **kwargs):
+    use_bf16, memory_format = self._cpu_preset
+    if memory_format is not None:
+        args = tuple(
+            arg.contiguous(memory_format=memory_format) if isinstance(arg, torch.Tensor) else arg for arg in args
+        )
+    if not use_bf16:
+        return type(self).forward(self, *args, **kwargs)
+    with torch.autocast(device_type="cpu", dtype=torch.bfloat16):
+        output = type(self).forward(self, *args, **kwargs)
+    return output.float()
+
+
+# Replace the forward pass of the model (only for this instance) with the forward pass of the CPU preset.
+# We don't wrap the model in another module, so that the checkpoints stay compatible with 'load_model'.
+# We bind the function as method, so that copies of the model (copy.deepcopy) use their own forward pass.
+def _set_cpu_forward(model, use_bf16, memory_format):
+    model._cpu_preset = (use_bf16, memory_format)
+    model.forward = types.MethodType(_cpu_forward, model)
+
+
+# Undo the CPU preset for a model (in-place): restore the default forward pass and memory format.
+def _remove_cpu_preset(model):
+    if hasattr(model, "_cpu_preset"):
+        del model.forward
+        del model._cpu_preset
+    model.to(memory_format=torch.contiguous_format)
+    return model
+
+
+# Get the keyword arguments for 'torch_em.default_segmentation_trainer' for the current hardware.
+# If a GPU is available, we return the GPU settings that are used in the training scripts.
+# Otherwise we apply the CPU preset to the model (in-place) and return the corresponding settings.
+# 'ndim' is the dimensionality of the model (2 for UNet2d, 3 for UNet3d / AnisotropicUNet).
+# 'compile_model' can be set to True or to a mode for torch.compile, e.g. "max-autotune".
+def get_training_settings(model, ndim, use_bf16=None, channels_last=True, compile_model=False):
+    if torch.cuda.is_available():
+        return {"mixed_precision": True, "compile_model": compile_model}
+
+    set_cpu_threads()
+    use_bf16 = cpu_supports_bf16() if use_bf16 is None else use_bf16
+
+    memory_format = None
+    if channels_last:
+        memory_format = torch.channels_last if ndim == 2 else torch.channels_last_3d
+        model.to(memory_format=memory_format)
+
+    if use_bf16 or memory_format is not None:
+        _set_cpu_forward(model, use_bf16, memory_format)
+
+    # We don't use the mixed precision of the trainer (which scales the gradients for float16),
+    # because bfloat16 autocast is already enabled in the forward pass and does not need gradient scaling.
+    return {"mixed_precision": False, "compile_model": compile_model, "device": torch.device("cpu")}
+
+
+def _train_iterations(model, loader, loss, n_iterations, learning_rate):
+    optimizer = torch.optim.Adam(model.parameters(), lr=learning_rate)
+    losses = []
+    iteration = 0
+    start = time.time()
+    while iteration < n_iterations:
+        for x, y in loader:
+            optimizer.zero_grad()
+            loss_value = loss(model(x), y)
+            loss_value.backward()
+            optimizer.step()
+            losses.append(loss_value.item())
+            iteration += 1
+            if iteration == n_iterations:
+                break
+    duration = time.time() - start
+    # We report the average loss over the last 10% of the iterations to check convergence.
+    n_last = max(1, n_iterations // 10)
+    return {"iterations_per_second": n_iterations / duration, "final_loss": sum(losses[-n_last:]) / n_last}
+
+
+# Compare the throughput and convergence of the CPU preset with the float32 baseline.
+# Both models start from the same weights and are trained for 'n_iterations' with the same data.
+# The final loss of both runs should be similar; if it is much higher for the preset, don't use bfloat16.
+# Note: with 'compile_model' the compilation time is included in the measurement, so use more iterations.
+# The model may already have the preset applied by 'get_training_settings': we remove it from the copies,
+# so that the baseline is trained in float32 with the default memory format.
+def compare_with_fp32(model, loader, loss, ndim, n_iterations=50, learning_rate=1e-4, **preset_kwargs):
+    baseline_model = _remove_cpu_preset(copy.deepcopy(model))
+    preset_model = _remove_cpu_preset(copy.deepcopy(model))
+    set_cpu_threads()
+
+    torch.manual_seed(0)
+    baseline = _train_iterations(baseline_model, loader, loss, n_iterations, learning_rate)
+
+    settings = get_training_settings(preset_model, ndim, **preset_kwargs)
+    if settings["compile_model"]:
+        mode = settings["compile_model"] if isinstance(settings["compile_model"], str) else None
+        preset_model = torch.compile(preset_model, mode=mode)
+    torch.manual_seed(0)
+    preset = _train_iterations(preset_model, loader, loss, n_iterations, learning_rate)
+
+    print("float32 baseline:", baseline)
+    print("CPU preset:", preset)
+    print("Speed-up:", preset["iterations_per_second"] / baseline["iterations_per_second"])
+    return baseline, preset
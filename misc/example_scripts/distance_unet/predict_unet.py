@@ -8,20 +8,49 @@ import torch_em
 from torch_em.util.prediction import predict_with_halo
 from torch_em.util import load_model
 
+# The automatic tiling is implemented in 'tiling.py' in the parent folder.
+import sys
+sys.path.append("..")
+from tiling import get_tiling
+
+# The global normalization is implemented in 'intensity_statistics.py' in the root folder of this repository.
+sys.path.append("../../..")
+from intensity_statistics import GlobalNormalization, read_model_statistics
+
 # First we load our data. Here, we load example data for 3D nucleus segmentation.
 # CHANGE THIS TO LOAD YOUR DATA.
 path = "../data/covid-if/gt_image_000.h5"
+# The scale level to load: 's0' is the full resolution. For a quick look you can use a downsampled level,
+# e.g. 's1' or 's2', after creating them with 'pyramid.py' in the root folder of this repository:
+# python ../../../pyramid.py ../data/covid-if/*.h5
+# Note that the model was trained on 's0', so the prediction on a downsampled level is only approximate.
+scale = "s0"
 with h5py.File(path, "r") as f:
-    image = f["/raw/serum_IgG/s0"][:]
+    image = f[f"/raw/serum_IgG/{scale}"][:]
 
 # Now we load our trained model.
 # CHANGE THIS FOR YOUR MODEL.
-model = load_model("./checkpoints/my-model")
+checkpoint = "./checkpoints/my-model"
+model = load_model(checkpoint)
+
+# Set this to True to normalize all tiles with the statistics of the training data, instead of normalizing each tile
+# with its own mean and standard deviation. This avoids differences between the tiles, which can lead to seams.
+# This requires that the model was trained with 'use_global_normalization = True', which saves the statistics
+# of the training data in the checkpoint folder. This way the same normalization is used as in training.
+use_global_normalization = False
+if use_global_normalization:
+    preprocess = GlobalNormalization(read_model_statistics(checkpoint))
+else:
+    preprocess = torch_em.transform.raw.standardize
 
 # Run the prediction with tiling. There are two important parameters:
-tile_shape = (512, 512)  # This is the inner shape of the tile.
-overlap = (32, 32)  # This is the overlap between tiles. It is added to the inner shape.
-# You can do the same in 3D, you just have to select a 3D tile shape and overlap.
+# - tile_shape: This is the inner shape of the tile.
+# - overlap: This is the overlap between tiles. It is added to the inner shape.
+# We select them automatically with 'get_tiling' (see 'tiling.py' in the parent folder), which benchmarks a few
+# tile shapes that fit into the memory of this machine. The result is cached, so this only takes long the first time.
+# You can also set them by hand, e.g. tile_shape = (512, 512) and overlap = (32, 32).
+# You can do the same in 3D, 'get_tiling' will then return a 3D tile shape and overlap.
+tile_shape, overlap = get_tiling(model, image.shape)
 prediction = predict_with_halo(
     input_=image,
     model=model,
@@ -29,7 +58,7 @@ prediction = predict_with_halo(
     block_shape=tile_shape,
     halo=overlap,
     # Important: use the same data preprocessing as in training.
-    preprocess=torch_em.transform.raw.standardize,
+    preprocess=preprocess,
 )
 
 # We can compute the segmentation based on the distance predictions.
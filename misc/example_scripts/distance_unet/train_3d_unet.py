@@ -3,6 +3,11 @@ import torch_em
 from torch_em.model import AnisotropicUNet
 from torch_em.util.debug import check_loader
 
+# The CPU performance settings are implemented in 'cpu_training.py' in the parent folder.
+import sys
+sys.path.append("..")
+from cpu_training import get_training_settings
+
 
 # Download the example data. Here, we use 3D fluorescent microscopy data of nuclei.
 def download_example_data():
@@ -109,6 +114,11 @@ if check_loaders:
     check_loader(train_loader, n_samples=4)
     check_loader(val_loader, n_samples=4)
 
+# Get the performance settings for the trainer.
+# If you train on a CPU, this will also change the model for faster training (see 'cpu_training.py').
+# You can check the speed-up and convergence compared to float32 with 'compare_with_fp32(model, train_loader, loss, ndim=3)'.
+training_settings = get_training_settings(model, ndim=3)
+
 # Create the trainer:
 # The trainer class implements all relevant logic for model training, validation, etc.
 name = "my-3d-model"  # Set the name of your model. Checkpoints will be saved under this name.
@@ -124,8 +134,8 @@ trainer = torch_em.default_segmentation_trainer(
     metric=loss,
     learning_rate=learning_rate,
     # These are advanced settings you don't need to change.
-    mixed_precision=True,
-    compile_model=False,
+    # They enable mixed precision on a GPU and a preset with bfloat16 / channels-last on a CPU.
+    **training_settings,
 )
 
 # Run training:
@@ -8,6 +8,13 @@ import torch_em
 from torch_em.util.prediction import predict_with_halo
 from torch_em.util import load_model
 
+from tiling import get_tiling
+
+# The global normalization is implemented in 'intensity_statistics.py' in the root folder of this repository.
+import sys
+sys.path.append("../..")
+from intensity_statistics import GlobalNormalization, read_model_statistics
+
 # First we load our data. Here, we load example data for 3D nucleus segmentation.
 # CHANGE THIS TO LOAD YOUR DATA.
 path = "data/Mouse-Skull-Nuclei-CBG/test/images/X2_right.tif"
@@ -15,12 +22,27 @@ image = imageio.imread(path)
 
 # Now we load our trained model.
 # CHANGE THIS FOR YOUR MODEL.
-model = load_model("./checkpoints/my-3d-model")
+checkpoint = "./checkpoints/my-3d-model"
+model = load_model(checkpoint)
+
+# Set this to True to normalize all tiles with the statistics of the training data, instead of normalizing each tile
+# with its own mean and standard deviation. This avoids differences between the tiles, which can lead to seams.
+# This requires that the model was trained with 'use_global_normalization = True', which saves the statistics
+# of the training data in the checkpoint folder. This way the same normalization is used as in training.
+use_global_normalization = False
+if use_global_normalization:
+    preprocess = GlobalNormalization(read_model_statistics(checkpoint))
+else:
+    preprocess = torch_em.transform.raw.standardize
 
 # Run the prediction with tiling. There are two important parameters:
-tile_shape = (32, 256, 256)  # This is the inner shape of the tile.
-overlap = (8, 32, 32)  # This is the overlap between tiles. It is added to the inner shape.
-# You can do the same in 2D, you just have to select a 2d tile shape and overlap.
+# - tile_shape: This is the inner shape of the tile.
+# - overlap: This is the overlap between tiles. It is added to the inner shape.
+# We select them automatically with 'get_tiling' (see 'tiling.py'), which benchmarks a few tile shapes that fit
+# into the memory of this machine. The result is cached, so this only takes long the first time.
+# You can also set them by hand, e.g. tile_shape = (32, 256, 256) and overlap = (16, 32, 32).
+# You can do the same in 2D, 'get_tiling' will then return a 2d tile shape and overlap.
+tile_shape, overlap = get_tiling(model, image.shape)
 prediction = predict_with_halo(
     input_=image,
     model=model,
@@ -28,7 +50,7 @@ prediction = predict_with_halo(
     block_shape=tile_shape,
     halo=overlap,
     # Important: use the same data preprocessing as in training.
-    preprocess=torch_em.transform.raw.standardize,
+    preprocess=preprocess,
 )
 
 # In the end we check the result in napari.
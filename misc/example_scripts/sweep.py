@@ -0,0 +1,188 @@
+# Train several models on the same data stream, e.g. for a hyperparameter sweep over learning rates,
+# loss functions or U-Net sizes. Instead of running a separate training (with its own data loader and workers)
+# for each setting, the data is loaded and transformed only once and each batch is passed to all the models.
+# Each model is trained by its own torch_em trainer, so checkpoints and logs are written per model as usual:
+# checkpoints/{name}/best.pt, checkpoints/{name}/latest.pt and logs/{name}.
+# The trainers either run in threads of the same process or in separate processes. In the latter case
+# the batches are passed to the processes via shared memory.
+import queue
+import threading
+
+import torch
+import torch.multiprocessing as mp
+
+# Marks the end of an epoch in the queues.
+_END_OF_EPOCH = "end-of-epoch"
+
+
+class _StreamConsumer:
+    """The loader for one of the trainers. It returns the batches that the stream puts into its queue.
+
+    All other attributes (e.g. 'dataset' or 'batch_size') are forwarded to the original loader,
+    so that the trainer can use it like the original loader.
+    """
+    def __init__(self, loader, batch_queue):
+        self.loader = loader
+        self.batch_queue = batch_queue
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        while True:
+            batch = self.batch_queue.get()
+            if isinstance(batch, str) and batch == _END_OF_EPOCH:
+                return
+            yield batch
+
+    def __getattr__(self, name):
+        # The 'loader' attribute is not set yet when the consumer is unpickled in the training process.
+        if name == "loader":
+            raise AttributeError(name)
+        return getattr(self.loader, name)
+
+
+class SharedLoaderStream:
+    """Share the batches of one data loader between several consumers.
+
+    The data loader is iterated in a background thread and each batch is put into the queue of each consumer.
+    The consumers that are faster than the others wait, so that the loader does not run ahead by more than
+    'max_prefetch' batches. A consumer that stops reading (e.g. because its training has finished or failed)
+    must be removed with 'remove_consumer', otherwise its queue runs full and the other consumers wait forever.
+
+    :param loader: the data loader.
+    :param n_consumers: the number of consumers (= the number of models trained in the sweep).
+    :param max_prefetch: the maximal number of batches that are loaded ahead of the slowest consumer.
+    :param use_processes: whether the consumers run in separate processes.
+        In this case the batches are moved to shared memory before they are put into the queues.
+    """
+    def __init__(self, loader, n_consumers, max_prefetch=4, use_processes=False, mp_context=None):
+        self.loader = loader
+        self.use_processes = use_processes
+        if use_processes:
+            self.queues = [mp_context.Queue(maxsize=max_prefetch) for _ in range(n_consumers)]
+        else:
+            self.queues = [queue.Queue(maxsize=max_prefetch) for _ in range(n_consumers)]
+        self._stop = threading.Event()
+        self._removed = set()
+        self._thread = None
+
+    def get_consumer(self, index):
+        return _StreamConsumer(self.loader, self.queues[index])
+
+    # Stop passing batches to the consumer with this index.
+    def remove_consumer(self, index):
+        self._removed.add(index)
+
+    def _put(self, index, item):
+        # We use a timeout so that we can stop the stream or skip a removed consumer while it is not reading.
+        while not self._stop.is_set() and index not in self._removed:
+            try:
+                self.queues[index].put(item, timeout=1.0)
+                return
+            except queue.Full:
+                continue
+
+    def _put_all(self, item):
+        for index in range(len(self.queues)):
+            if index not in self._removed:
+                self._put(index, item)
+
+    def _produce(self):
+        while not self._stop.is_set():
+            for batch in self.loader:
+                if self._stop.is_set():
+                    return
+                if self.use_processes:
+                    batch = tuple(tensor.share_memory_() for tensor in batch)
+                self._put_all(batch)
+            self._put_all(_END_OF_EPOCH)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._produce, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        # Don't wait for batches that were not consumed when the process exits.
+        if self.use_processes:
+            for batch_queue in self.queues:
+                batch_queue.cancel_join_thread()
+
+
+def _run_trainer(make_trainer, config, train_loader, val_loader, fit_kwargs, errors=None):
+    try:
+        trainer = make_trainer(config, train_loader, val_loader)
+        trainer.fit(**fit_kwargs)
+    except Exception as e:
+        # In a thread the exception would otherwise be lost, so we store it and raise it in the main thread.
+        if errors is None:
+            raise
+        errors.append((config, e))
+
+
+def run_sweep(configs, make_trainer, train_loader, val_loader, use_processes=False, max_prefetch=4, **fit_kwargs):
+    """Train one model per config, with all models sharing the same training and validation data stream.
+
+    :param configs: the settings for each model of the sweep, e.g. a list of dictionaries.
+    :param make_trainer: function that creates the trainer for a config, called as
+        'make_trainer(config, train_loader, val_loader)'. It must return a trainer with a 'fit' method,
+        e.g. from 'torch_em.default_segmentation_trainer'. Each trainer needs a different name, otherwise
+        the checkpoints are over-written. If 'use_processes' is True, it must be defined at the top level
+        of a module, so that it can be passed to the processes.
+    :param train_loader: the loader for the training data.
+    :param val_loader: the loader for the validation data.
+    :param use_processes: whether to train each model in a separate process. By default each model is trained
+        in a separate thread of this process.
+    :param max_prefetch: the maximal number of batches that are loaded ahead of the slowest trainer.
+    :param fit_kwargs: the arguments for 'trainer.fit', e.g. 'iterations'.
+    """
+    n_models = len(configs)
+    mp_context = mp.get_context("spawn") if use_processes else None
+    train_stream = SharedLoaderStream(train_loader, n_models, max_prefetch, use_processes, mp_context)
+    val_stream = SharedLoaderStream(val_loader, n_models, max_prefetch, use_processes, mp_context)
+
+    args = [
+        (make_trainer, config, train_stream.get_consumer(i), val_stream.get_consumer(i), fit_kwargs)
+        for i, config in enumerate(configs)
+    ]
+    # Note: we start the processes before the streams, so that they don't inherit the running threads.
+    n_threads = torch.get_num_threads()
+    if use_processes:
+        workers = [mp_context.Process(target=_run_trainer, args=arg) for arg in args]
+    else:
+        errors = []
+        workers = [threading.Thread(target=_run_trainer, args=arg + (errors,)) for arg in args]
+        # The threads run in parallel, because pytorch releases the GIL during computation.
+        # We divide the threads pytorch uses between the models.
+        torch.set_num_threads(max(1, n_threads // n_models))
+
+    try:
+        for worker in workers:
+            worker.start()
+        train_stream.start()
+        val_stream.start()
+
+        # Wait for the trainers. When a trainer has finished (or failed) we remove it from the streams,
+        # so that the other trainers still get their batches.
+        running = set(range(n_models))
+        while running:
+            for index in list(running):
+                workers[index].join(timeout=1.0)
+                if not workers[index].is_alive():
+                    train_stream.remove_consumer(index)
+                    val_stream.remove_consumer(index)
+                    running.remove(index)
+    finally:
+        train_stream.stop()
+        val_stream.stop()
+        torch.set_num_threads(n_threads)
+
+    if use_processes:
+        failed = [config for config, worker in zip(configs, workers) if worker.exitcode != 0]
+    else:
+        failed = [config for config, _ in errors]
+    if failed:
+        raise RuntimeError(f"The training failed for the configs {failed}.")
@@ -0,0 +1,258 @@
+# Automatic selection of the tile shape and overlap for tiled prediction with 'predict_with_halo'.
+# The best tile shape depends on the memory and number of cores of the machine and on the model.
+# Here, we benchmark a few valid candidate tile shapes that fit into the memory budget and select the fastest one.
+# The result is stored in a small json file per model and machine, so that the benchmark only runs once.
+import hashlib
+import json
+import math
+import os
+import socket
+import time
+from itertools import product
+
+import torch
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "dl-for-micro", "tiling.json")
+
+# The candidate sizes for the inner tile shape, for the in-plane axes and the z-axis (for 3D).
+CANDIDATE_SIZES = (128, 192, 256, 384, 512, 768, 1024)
+CANDIDATE_SIZES_Z = (8, 16, 24, 32, 48, 64)
+
+
+# Get the factor that the input shape of the U-Net must be divisible by, for each axis.
+# This is the product of the downsampling factors of the encoder: 2 ** depth for the UNet2d / UNet3d
+# and the product of the 'scale_factors' per axis for the AnisotropicUNet.
+# (The AnisotropicUNet from torch_em only stores the scale factors in 'init_kwargs'.)
+def get_divisibility(model, ndim, depth=4):
+    scale_factors = getattr(model, "scale_factors", None)
+    if scale_factors is None:
+        scale_factors = getattr(model, "init_kwargs", {}).get("scale_factors", None)
+    if scale_factors is not None:
+        divisibility = [1] * ndim
+        for factors in scale_factors:
+            factors = [factors] * ndim if isinstance(factors, int) else factors
+            divisibility = [div * fac for div, fac in zip(divisibility, factors)]
+        return tuple(divisibility)
+    depth = getattr(model, "depth", depth)
+    return (2 ** depth,) * ndim
+
+
+# Get the minimal overlap so that the tile borders are not affected by the missing context.
+# This is the margin of the receptive field of the model: each convolution adds (kernel_size - 1) / 2 * dilation
+# pixels of context at the resolution it is applied at, so it adds this value times its downsampling factor
+# in the full resolution. We find the convolutions and their downsampling factors by running the model once
+# for a small input. (The context added by the pooling and upsampling layers is small and not included.)
+def get_min_overlap(model, ndim, divisibility=None):
+    divisibility = get_divisibility(model, ndim) if divisibility is None else divisibility
+    probe_shape = tuple(2 * div for div in divisibility)
+    margin = [0.0] * ndim
+
+    def hook(module, args, output):
+        in_shape = args[0].shape[2:]
+        kernel_size = module.kernel_size if isinstance(module.kernel_size, tuple) else (module.kernel_size,) * ndim
+        dilation = module.dilation if isinstance(module.dilation, tuple) else (module.dilation,) * ndim
+        for axis in range(ndim):
+            scale = probe_shape[axis] / in_shape[axis]
+            margin[axis] += (kernel_size[axis] - 1) / 2 * dilation[axis] * scale
+
+    conv_types = (torch.nn.Conv2d,) if ndim == 2 else (torch.nn.Conv3d,)
+    handles = [module.register_forward_hook(hook) for module in model.modules() if isinstance(module, conv_types)]
+    device = next(model.parameters()).device
+    try:
+        with torch.no_grad():
+            model(torch.rand((1, _get_in_channels(model)) + probe_shape, device=device))
+    finally:
+        for handle in handles:
+            handle.remove()
+    return tuple(int(math.ceil(m)) for m in margin)
+
+
+def _round_up(value, factor):
+    return ((value + factor - 1) // factor) * factor
+
+
+# Check that the tile shape and overlap are valid for the model.
+def check_tiling(tile_shape, overlap, divisibility, min_overlap):
+    for tile, halo, div, min_halo in zip(tile_shape, overlap, divisibility, min_overlap):
+        if tile % div != 0:
+            raise ValueError(f"The tile shape {tile_shape} is not divisible by {divisibility}.")
+        if (tile + 2 * halo) % div != 0:
+            raise ValueError(f"The full tile shape for {tile_shape} and overlap {overlap} is not divisible by {divisibility}.")
+        if halo < min_halo:
+            raise ValueError(f"The overlap {overlap} is smaller than the minimal overlap {min_overlap}.")
+
+
+# Clip the tile shape to the image shape (rounded up to be divisible), because we don't need larger tiles.
+def _clip_tile_shape(tile_shape, image_shape, divisibility):
+    return tuple(min(tile, _round_up(sh, div)) for tile, sh, div in zip(tile_shape, image_shape, divisibility))
+
+
+# Get the candidate tile shapes. If the image shape is given, they are clipped to it.
+def _get_candidates(ndim, divisibility, image_shape=None):
+    candidates = set()
+    # We use the same size for the in-plane axes and vary the z-size for 3D.
+    z_sizes = CANDIDATE_SIZES_Z if ndim == 3 else (None,)
+    for size, z_size in product(CANDIDATE_SIZES, z_sizes):
+        shape = [_round_up(size, div) for div in divisibility[-2:]]
+        if ndim == 3:
+            shape = [_round_up(z_size, divisibility[0])] + shape
+        if image_shape is not None:
+            shape = _clip_tile_shape(shape, image_shape, divisibility)
+        candidates.add(tuple(shape))
+    return sorted(candidates)
+
+
+# Estimate the memory needed per pixel of the input, by summing up the outputs of all layers for a small tile.
+# This is an upper bound, because intermediate outputs are freed during inference.
+def _estimate_memory_per_pixel(model, in_channels, shape, device):
+    total = [0]
+
+    def hook(module, args, output):
+        if isinstance(output, torch.Tensor):
+            total[0] += output.numel() * output.element_size()
+
+    handles = [module.register_forward_hook(hook) for module in model.modules() if module is not model]
+    try:
+        with torch.no_grad():
+            model(torch.rand((1, in_channels) + tuple(shape), device=device))
+    finally:
+        for handle in handles:
+            handle.remove()
+    n_pixels = 1
+    for sh in shape:
+        n_pixels *= sh
+    return total[0] / n_pixels
+
+
+def _get_in_channels(model):
+    in_channels = getattr(model, "in_channels", None)
+    if in_channels is not None:
+        return in_channels
+    for module in model.modules():
+        if isinstance(module, (torch.nn.Conv2d, torch.nn.Conv3d)):
+            return module.in_channels
+    return 1
+
+
+def _get_memory_budget(device):
+    if device.type == "cuda":
+        free, _ = torch.cuda.mem_get_info(device)
+        return 0.8 * free
+    # On the CPU we use half of the available memory.
+    return 0.5 * os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+
+
+def _benchmark(model, in_channels, full_shape, device, n_repeats):
+    x = torch.rand((1, in_channels) + tuple(full_shape), device=device)
+    with torch.no_grad():
+        model(x)  # Warm-up.
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+        start = time.perf_counter()
+        for _ in range(n_repeats):
+            model(x)
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+    return (time.perf_counter() - start) / n_repeats
+
+
+# The key for the cache: the model architecture (not the weights), the machine, the device and the memory budget.
+# If no memory budget was given, it is derived from the free memory, which changes between runs.
+# In this case we don't include it, so that the result is re-used on this machine.
+def _get_cache_key(model, device, memory_budget_gb=None):
+    architecture = type(model).__name__ + str([tuple(p.shape) for p in model.parameters()])
+    model_hash = hashlib.sha256(architecture.encode()).hexdigest()[:16]
+    budget = "auto" if memory_budget_gb is None else f"{memory_budget_gb:g}GB"
+    return f"{model_hash}:{socket.gethostname()}:{device}:{budget}"
+
+
+def tune_tiling(
+    model, image_shape, memory_budget_gb=None, device=None, n_candidates=5, n_repeats=2, min_overlap=None,
+    clip_to_image=True,
+):
+    """Select the tile shape and overlap with the highest throughput that fit into the memory budget.
+
+    :param model: the model used for prediction.
+    :param image_shape: the spatial shape of the image (2D or 3D).
+    :param clip_to_image: whether to clip the candidate tile shapes to the image shape.
+        Otherwise only the dimensionality of 'image_shape' is used.
+    :param memory_budget_gb: the memory budget in GB. By default 80% of the free GPU memory
+        or 50% of the available CPU memory is used.
+    :param device: the device used for prediction. By default the GPU, if available.
+    :param n_candidates: the number of candidate tile shapes that are benchmarked.
+    :param n_repeats: the number of predictions per candidate in the benchmark.
+    :param min_overlap: the minimal overlap. By default it is the receptive field margin of the model.
+    :returns:
+        - tile_shape - the inner shape of the tiles
+        - overlap - the overlap between tiles
+    """
+    ndim = len(image_shape)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu") if device is None else torch.device(device)
+    model = model.to(device).eval()
+    memory_budget = _get_memory_budget(device) if memory_budget_gb is None else memory_budget_gb * 1e9
+
+    divisibility = get_divisibility(model, ndim)
+    min_overlap = get_min_overlap(model, ndim, divisibility) if min_overlap is None else tuple(min_overlap)
+    overlap = tuple(_round_up(halo, max(1, div // 2)) for halo, div in zip(min_overlap, divisibility))
+
+    in_channels = _get_in_channels(model)
+    probe_shape = tuple(2 * div for div in divisibility)
+    memory_per_pixel = _estimate_memory_per_pixel(model, in_channels, probe_shape, device)
+
+    # Filter the candidates that fit into the memory budget and benchmark the largest ones.
+    candidates = []
+    for tile_shape in _get_candidates(ndim, divisibility, image_shape if clip_to_image else None):
+        full_shape = tuple(tile + 2 * halo for tile, halo in zip(tile_shape, overlap))
+        n_pixels = 1
+        for sh in full_shape:
+            n_pixels *= sh
+        if n_pixels * memory_per_pixel <= memory_budget:
+            candidates.append((n_pixels, tile_shape, full_shape))
+    if not candidates:
+        raise RuntimeError(f"None of the candidate tile shapes fits into the memory budget of {memory_budget / 1e9} GB.")
+    candidates = sorted(candidates, reverse=True)[:n_candidates]
+
+    best_tile_shape, best_throughput = None, 0.0
+    for _, tile_shape, full_shape in candidates:
+        check_tiling(tile_shape, overlap, divisibility, min_overlap)
+        duration = _benchmark(model, in_channels, full_shape, device, n_repeats)
+        # The throughput is measured in predicted pixels (= the inner tile shape) per second.
+        n_inner_pixels = 1
+        for sh in tile_shape:
+            n_inner_pixels *= sh
+        throughput = n_inner_pixels / duration
+        if throughput > best_throughput:
+            best_tile_shape, best_throughput = tile_shape, throughput
+
+    return best_tile_shape, overlap
+
+
+def get_tiling(model, image_shape, memory_budget_gb=None, device=None, cache_path=DEFAULT_CACHE_PATH, **kwargs):
+    """Get the tile shape and overlap for tiled prediction, using the cached result if available.
+
+    See 'tune_tiling' for the arguments.
+    """
+    ndim = len(image_shape)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu") if device is None else torch.device(device)
+    # The minimal overlap is part of the key, so that a different overlap is tuned separately.
+    min_overlap = kwargs.pop("min_overlap", None)
+    min_overlap = get_min_overlap(model.to(device).eval(), ndim) if min_overlap is None else tuple(min_overlap)
+    key = f"{_get_cache_key(model, device, memory_budget_gb)}:{ndim}D:overlap{list(min_overlap)}"
+
+    cache = {}
+    if os.path.exists(cache_path):
+        with open(cache_path) as f:
+            cache = json.load(f)
+    if key not in cache:
+        # We tune the tile shape independently of this image, so that the result can be used for all images.
+        tile_shape, overlap = tune_tiling(
+            model, image_shape, memory_budget_gb, device, min_overlap=min_overlap, clip_to_image=False, **kwargs
+        )
+        cache[key] = {"tile_shape": list(tile_shape), "overlap": list(overlap)}
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        with open(cache_path, "w") as f:
+            json.dump(cache, f, indent=2)
+
+    # The tuned tile shape may be larger than this image, so we clip it to the (divisible) image shape.
+    tile_shape = _clip_tile_shape(cache[key]["tile_shape"], image_shape, get_divisibility(model, ndim))
+    return tile_shape, tuple(cache[key]["overlap"])
@@ -6,6 +6,14 @@ import torch_em
 from torch_em.model import UNet2d
 from torch_em.util.debug import check_loader
 
+from cpu_training import get_training_settings
+
+# The batch augmentations are implemented in 'batch_augmentation.py' in the root folder of this repository.
+import sys
+sys.path.append("../..")
+from batch_augmentation import BatchAugmentation, BatchAugmentationLoader, no_augmentation, to_float32
+from intensity_statistics import GlobalNormalization, compute_dataset_statistics, write_model_statistics
+
 from sklearn.model_selection import train_test_split
 
 
@@ -73,6 +81,26 @@ label_key = "/labels/cells/s0"
 # raw_key = None
 # label_key = None
 
+# Set this to True to normalize all patches with the statistics of the whole training set, instead of standardizing
+# each patch with its own mean and standard deviation. The statistics are saved in the checkpoint folder,
+# so that the same normalization is used for prediction if you set 'use_global_normalization' to True there.
+use_global_normalization = False
+if use_global_normalization:
+    intensity_statistics = compute_dataset_statistics(train_image_paths, key=raw_key)
+    raw_transform = GlobalNormalization(intensity_statistics)
+
+# By default the data augmentations and the standardization are applied to each sample in the data loader.
+# Set 'use_batch_augmentation = True' to apply them to whole batches instead, which is faster for small patches.
+# In this case the data loader only loads the data and the augmentations are applied after the batch is collated.
+use_batch_augmentation = False
+if use_batch_augmentation:
+    # With global normalization the data loader still normalizes the data, otherwise it only casts it to float.
+    if not use_global_normalization:
+        raw_transform = to_float32
+    transform = no_augmentation
+else:
+    transform = None  # This means that the default augmentations of torch_em are used.
+
 # Create the data loaders:
 # The function below automatically creates suitable data loaders.
 batch_size = 4  # Set the batch size.
@@ -86,6 +114,7 @@ train_loader = torch_em.segmentation.default_segmentation_loader(
     patch_shape=patch_shape,
     label_transform=label_transform,
     raw_transform=raw_transform,
+    transform=transform,
 )
 val_loader = torch_em.segmentation.default_segmentation_loader(
     raw_paths=val_image_paths,
@@ -96,8 +125,24 @@ val_loader = torch_em.segmentation.default_segmentation_loader(
     patch_shape=patch_shape,
     label_transform=label_transform,
     raw_transform=raw_transform,
+    transform=transform,
 )
 
+# Wrap the loaders so that the augmentations are applied to each batch.
+# The same geometric transformations are applied to the images and labels.
+# Here, the labels are already transformed into boundary and foreground maps by the 'label_transform',
+# so we only use flips and rotations by 90 degrees, which are exact. Affine and elastic deformations
+# would break or thicken the one pixel wide boundaries.
+# For validation we only standardize the images (if they are not normalized globally already).
+if use_batch_augmentation:
+    standardize = not use_global_normalization
+    train_loader = BatchAugmentationLoader(
+        train_loader, BatchAugmentation(flip=True, rot90=True, standardize=standardize)
+    )
+    val_loader = BatchAugmentationLoader(
+        val_loader, BatchAugmentation(flip=False, rot90=False, intensity_jitter=False, standardize=standardize)
+    )
+
 # If set to True, this will open 4 samples from the training loader and from
 # the validation loader in napari. This is very helpful to check that your
 # training data is loaded correctly and that data and label transformation are
@@ -107,12 +152,20 @@ if check_loaders:
     check_loader(train_loader, n_samples=4)
     check_loader(val_loader, n_samples=4)
 
+# Get the performance settings for the trainer.
+# If you train on a CPU, this will also change the model for faster training (see 'cpu_training.py').
+# You can check the speed-up and convergence compared to float32 with 'compare_with_fp32(model, train_loader, loss, ndim=2)'.
+training_settings = get_training_settings(model, ndim=2)
+
 # Create the trainer:
 # The trainer class implements all relevant logic for model training, validation, etc.
 name = "my-model"  # Set the name of your model. Checkpoints will be saved under this name.
 # IMPORTANT: IF YOU START A NEW TRAINING YOU HAVE TO CHANGE THE NAME.
 # OTHERWISE YOUR PREVIOUS CHECKPOINTS WILL BE OVER-WRITTEN.
 learning_rate = 1e-4  # Set the learning rate.
+# Save the statistics for the global normalization with the checkpoints.
+if use_global_normalization:
+    write_model_statistics(f"./checkpoints/{name}", intensity_statistics)
 trainer = torch_em.default_segmentation_trainer(
     name=name,
     model=model,
@@ -122,8 +175,8 @@ trainer = torch_em.default_segmentation_trainer(
     metric=loss,
     learning_rate=learning_rate,
     # These are advanced settings you don't need to change.
-    mixed_precision=True,
-    compile_model=False,
+    # They enable mixed precision on a GPU and a preset with bfloat16 / channels-last on a CPU.
+    **training_settings,
 )
 
 # Run training:
@@ -0,0 +1,105 @@
+# This is an example script for a hyperparameter sweep: it trains several 2D U-Nets with different settings.
+# The data is loaded only once and each batch is passed to all the models (see 'sweep.py').
+# It uses the same data and setup as 'train_2d_unet.py'.
+# Import functionality for getting filepaths.
+from glob import glob
+
+# Import the required functionality from torch-em.
+import torch_em
+from torch_em.model import UNet2d
+
+from sklearn.model_selection import train_test_split
+
+from sweep import run_sweep
+
+
+# Download the example data. Here, we use the same data as in the exercises.
+def download_example_data():
+    from torch_em.data.datasets.light_microscopy.covid_if import get_covid_if_data
+    get_covid_if_data("./data/covid-if", download=True)
+
+
+# Get the paths to the data. See 'train_2d_unet.py' for details.
+def get_data_paths(split):
+    all_paths = sorted(glob("./data/covid-if/*.h5"))
+    train_paths, val_paths = train_test_split(all_paths, test_size=0.1, random_state=42)
+    if split == "train":
+        return train_paths, train_paths
+    elif split == "val":
+        return val_paths, val_paths
+    else:
+        raise ValueError(f"Invalid split: {split}")
+
+
+# The settings for the sweep. Each entry corresponds to one model that will be trained.
+# Here, we compare different learning rates and U-Net sizes ('initial_features').
+# IMPORTANT: each setting needs a different name. Otherwise the checkpoints will be over-written.
+# Note: all models are trained on the same data, so settings that change the data (e.g. the label transform
+# or the patch shape) can't be compared in the same sweep.
+configs = [
+    {"name": "sweep-lr1e-4-f32", "learning_rate": 1e-4, "initial_features": 32},
+    {"name": "sweep-lr1e-3-f32", "learning_rate": 1e-3, "initial_features": 32},
+    {"name": "sweep-lr1e-4-f16", "learning_rate": 1e-4, "initial_features": 16},
+    {"name": "sweep-lr1e-4-f64", "learning_rate": 1e-4, "initial_features": 64},
+]
+
+
+# This function creates the model and trainer for one setting of the sweep.
+# The data loaders passed to it return the batches that are shared between all the models.
+def make_trainer(config, train_loader, val_loader):
+    model = UNet2d(
+        in_channels=1,
+        out_channels=2,
+        initial_features=config["initial_features"],
+        final_activation="Sigmoid",
+    )
+    # You can also sweep over the loss function by adding it to the config.
+    loss = config.get("loss", torch_em.loss.DiceLoss())
+    return torch_em.default_segmentation_trainer(
+        name=config["name"],
+        model=model,
+        train_loader=train_loader,
+        val_loader=val_loader,
+        loss=loss,
+        metric=loss,
+        learning_rate=config["learning_rate"],
+        mixed_precision=True,
+        compile_model=False,
+    )
+
+
+# The code below must be run within this 'if' block if we use separate processes for training the models.
+if __name__ == "__main__":
+    download_example_data()
+    train_image_paths, train_label_paths = get_data_paths(split="train")
+    val_image_paths, val_label_paths = get_data_paths(split="val")
+
+    raw_key = "/raw/serum_IgG/s0"
+    label_key = "/labels/cells/s0"
+    label_transform = torch_em.transform.label.BoundaryTransform(add_binary_target=True, ndim=2)
+    raw_transform = torch_em.transform.raw.standardize
+
+    # Create the data loaders. They are shared by all models, so the data is loaded and transformed only once.
+    # You can use more workers here than for a single training, because there is only one loader for the sweep.
+    batch_size = 4
+    patch_shape = (256, 256)
+    train_loader = torch_em.segmentation.default_segmentation_loader(
+        raw_paths=train_image_paths, raw_key=raw_key,
+        label_paths=train_label_paths, label_key=label_key,
+        batch_size=batch_size, patch_shape=patch_shape,
+        label_transform=label_transform, raw_transform=raw_transform,
+        num_workers=8, shuffle=True,
+    )
+    val_loader = torch_em.segmentation.default_segmentation_loader(
+        raw_paths=val_image_paths, raw_key=raw_key,
+        label_paths=val_label_paths, label_key=label_key,
+        batch_size=batch_size, patch_shape=patch_shape,
+        label_transform=label_transform, raw_transform=raw_transform,
+        num_workers=4,
+    )
+
+    # Run the sweep. By default all models are trained in the same process (in separate threads).
+    # Set 'use_processes=True' to train each model in its own process instead. The batches are then
+    # passed to the processes via shared memory.
+    # The checkpoints and logs are saved per model, as for a single training: checkpoints/{name} and logs/{name}.
+    run_sweep(configs, make_trainer, train_loader, val_loader, use_processes=False, iterations=5000)
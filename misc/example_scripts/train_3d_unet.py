@@ -3,6 +3,13 @@ import torch_em
 from torch_em.model import AnisotropicUNet
 from torch_em.util.debug import check_loader
 
+from cpu_training import get_training_settings
+
+# The global normalization is implemented in 'intensity_statistics.py' in the root folder of this repository.
+import sys
+sys.path.append("../..")
+from intensity_statistics import GlobalNormalization, compute_dataset_statistics, write_model_statistics
+
 
 # Download the example data. Here, we use 3D fluorescent microscopy data of nuclei.
 def download_example_data():
@@ -74,6 +81,14 @@ val_image_path, val_label_path = get_data_paths(split="val")
 raw_key = None
 label_key = None
 
+# Set this to True to normalize all patches with the statistics of the whole training data, instead of standardizing
+# each patch with its own mean and standard deviation. The statistics are saved in the checkpoint folder,
+# so that the same normalization is used for prediction if you set 'use_global_normalization' to True there.
+use_global_normalization = False
+if use_global_normalization:
+    intensity_statistics = compute_dataset_statistics([train_image_path], key=raw_key)
+    raw_transform = GlobalNormalization(intensity_statistics)
+
 # Create the data loaders:
 # The function below automatically creates suitable data loaders.
 batch_size = 1  # Set the batch size.
@@ -108,12 +123,20 @@ if check_loaders:
     check_loader(train_loader, n_samples=4)
     check_loader(val_loader, n_samples=4)
 
+# Get the performance settings for the trainer.
+# If you train on a CPU, this will also change the model for faster training (see 'cpu_training.py').
+# You can check the speed-up and convergence compared to float32 with 'compare_with_fp32(model, train_loader, loss, ndim=3)'.
+training_settings = get_training_settings(model, ndim=3)
+
 # Create the trainer:
 # The trainer class implements all relevant logic for model training, validation, etc.
 name = "my-3d-model"  # Set the name of your model. Checkpoints will be saved under this name.
 # IMPORTANT: IF YOU START A NEW TRAINING YOU HAVE TO CHANGE THE NAME.
 # OTHERWISE YOUR PREVIOUS CHECKPOINTS WILL BE OVER-WRITTEN.
 learning_rate = 1e-4  # Set the learning rate.
+# Save the statistics for the global normalization with the checkpoints.
+if use_global_normalization:
+    write_model_statistics(f"./checkpoints/{name}", intensity_statistics)
 trainer = torch_em.default_segmentation_trainer(
     name=name,
     model=model,
@@ -123,8 +146,8 @@ trainer = torch_em.default_segmentation_trainer(
     metric=loss,
     learning_rate=learning_rate,
     # These are advanced settings you don't need to change.
-    mixed_precision=True,
-    compile_model=False,
+    # They enable mixed precision on a GPU and a preset with bfloat16 / channels-last on a CPU.
+    **training_settings,
 )
 
 # Run training:
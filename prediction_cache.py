@@ -0,0 +1,167 @@
+# A cache for the results of pretrained segmentation models (bioimage.io, cellpose, stardist).
+# Running these models takes a while, so we store the predictions and label images on disk
+# and re-use them if the same model is applied to the same image with the same parameters.
+# The heavy dependencies are imported inside the functions, like in 'utils.py'.
+import hashlib
+import json
+import os
+import time
+import warnings
+from functools import lru_cache
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "dl-for-micro", "predictions")
+
+
+# Compute a hash that identifies the image content.
+# We include the shape and dtype, so that images with the same bytes but a different layout differ.
+def hash_image(image):
+    import numpy as np
+    image = np.ascontiguousarray(image)
+    hasher = hashlib.sha256()
+    hasher.update(str(image.dtype).encode())
+    hasher.update(str(image.shape).encode())
+    hasher.update(image.data)
+    return hasher.hexdigest()
+
+
+# Compute the cache key from the image hash, the model id / version and the inference parameters.
+# The parameters must be json serializable (non-serializable values are converted to strings).
+def get_cache_key(image, model_id, model_version=None, **parameters):
+    description = json.dumps(
+        {"image": hash_image(image), "model_id": model_id, "model_version": model_version, "parameters": parameters},
+        sort_keys=True, default=str,
+    )
+    return hashlib.sha256(description.encode()).hexdigest()
+
+
+class PredictionCache:
+    """Size-bounded cache for predictions and label images.
+
+    Each entry is stored in a separate hdf5 file with chunked and compressed datasets.
+    If the total size of the cache exceeds 'max_size_gb', the least recently used entries are removed.
+
+    :param cache_dir: the folder for storing the cached results.
+    :param max_size_gb: the maximal size of the cache in GB.
+    """
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_size_gb=5.0):
+        self.cache_dir = cache_dir
+        self.max_size = int(max_size_gb * 1e9)
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.h5")
+
+    def __contains__(self, key):
+        return os.path.exists(self._path(key))
+
+    # Load a cached result. Returns None if the key is not in the cache.
+    def get(self, key):
+        import h5py
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None
+        with h5py.File(path, "r") as f:
+            result = {name: f[name][:] for name in f}
+            is_array = f.attrs.get("is_array", False)
+        # Update the access time, so that this entry is evicted last.
+        now = time.time()
+        os.utime(path, (now, now))
+        return result["data"] if is_array else result
+
+    # Store a result, which is either a single array or a dictionary of arrays.
+    def put(self, key, result):
+        import h5py
+        is_array = not isinstance(result, dict)
+        arrays = {"data": result} if is_array else result
+        path = self._path(key)
+        # Write to a temporary file first, so that an interrupted write does not leave a broken entry.
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with h5py.File(tmp_path, "w") as f:
+            for name, array in arrays.items():
+                # We use lzf compression, which is much faster to decompress than gzip.
+                chunks = True if getattr(array, "ndim", 0) > 0 else None
+                compression = "lzf" if chunks else None
+                f.create_dataset(name, data=array, chunks=chunks, compression=compression)
+            f.attrs["is_array"] = is_array
+        os.replace(tmp_path, path)
+        size = os.path.getsize(path)
+        if size > self.max_size:
+            warnings.warn(
+                f"The cache entry has a size of {size / 1e6:.1f} MB, which is larger than the maximal cache size of "
+                f"{self.max_size / 1e6:.1f} MB. It will be evicted when the next result is cached. "
+                "Increase 'max_size_gb' to keep such results in the cache."
+            )
+        # The entry that was just written is never evicted, even if it is larger than the maximal size.
+        # Otherwise results larger than the cache would be removed right away and never be found.
+        self.evict(keep=key)
+
+    # Remove the least recently used entries until the cache is smaller than the maximal size.
+    # The entry with the key 'keep' is not removed.
+    def evict(self, keep=None):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(".h5") or (keep is not None and name == f"{keep}.h5"):
+                continue
+            stat = os.stat(os.path.join(self.cache_dir, name))
+            entries.append((stat.st_mtime, stat.st_size, name))
+        total_size = sum(entry[1] for entry in entries)
+        if keep is not None and keep in self:
+            total_size += os.path.getsize(self._path(keep))
+        for _, size, name in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            os.remove(os.path.join(self.cache_dir, name))
+            total_size -= size
+
+    def clear(self):
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(".h5"):
+                os.remove(os.path.join(self.cache_dir, name))
+
+    # Return the cached result for this image, model and parameters, or compute and cache it.
+    # 'predict_function' is called as 'predict_function(image, **parameters)'.
+    def cached_prediction(self, predict_function, image, model_id, model_version=None, **parameters):
+        key = get_cache_key(image, model_id, model_version, **parameters)
+        result = self.get(key)
+        if result is None:
+            result = predict_function(image, **parameters)
+            self.put(key, result)
+        return result
+
+
+# Load a bioimage.io model description only once per process.
+# Calling this function again with the same model name returns the same description.
+@lru_cache(maxsize=None)
+def load_bioimageio_model(model_name):
+    import bioimageio.core as bioimageio
+    return bioimageio.load_model_description(model_name)
+
+
+# Create a bioimage.io prediction pipeline only once per process, so that the weights stay loaded.
+# The pipeline can be passed to 'bioimageio.core.predict' instead of the model description.
+@lru_cache(maxsize=None)
+def get_bioimageio_pipeline(model_name):
+    from bioimageio.core import create_prediction_pipeline
+    return create_prediction_pipeline(load_bioimageio_model(model_name))
+
+
+# Get the version of a bioimage.io model, to be used as part of the cache key.
+def get_bioimageio_model_version(model_name):
+    model = load_bioimageio_model(model_name)
+    version = getattr(model, "version", None)
+    return None if version is None else str(version)
+
+
+# Load a cellpose model only once per process.
+# The keyword arguments are passed to 'CellposeModel', e.g. 'pretrained_model'.
+@lru_cache(maxsize=None)
+def load_cellpose_model(gpu=False, **kwargs):
+    from cellpose import models
+    return models.CellposeModel(gpu=gpu, **kwargs)
+
+
+# Load a pretrained stardist model only once per process.
+@lru_cache(maxsize=None)
+def load_stardist_model(model_name="2D_versatile_fluo"):
+    from stardist.models import StarDist2D
+    return StarDist2D.from_pretrained(model_name)
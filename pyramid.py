@@ -0,0 +1,201 @@
+# Functionality for creating multiscale pyramids (s1, s2, ...) for the covid-if hdf5 files.
+# The files store the data in a scale layout (e.g. 'raw/serum_IgG/s0', 'labels/cells/s0'), but only contain
+# the full resolution 's0'. Here, we add downsampled levels for all raw and label datasets, so that viewers
+# (e.g. napari) and quick-look prediction can load a smaller level.
+# Image data (raw) is downsampled with the mean, label data with the mode (most frequent label in the window),
+# so that no new label ids are introduced.
+# You can run it from the command line via: python pyramid.py data/covid-if/*.h5
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import product
+
+import h5py
+import numpy as np
+
+
+# Find the names of all groups with a full resolution dataset 's0' below the 'raw' and 'labels' groups.
+def find_multiscale_groups(f):
+    names = []
+
+    def visitor(name, node):
+        if isinstance(node, h5py.Dataset) and name.endswith("/s0") and name.split("/")[0] in ("raw", "labels"):
+            names.append(name[:-len("/s0")])
+
+    f.visititems(visitor)
+    return names
+
+
+# Pad the block at the end, so that its shape is divisible by the scale factor.
+def _pad_to_factor(block, factor):
+    pad_width = [(0, (factor - sh % factor) % factor) for sh in block.shape]
+    if any(pw[1] > 0 for pw in pad_width):
+        block = np.pad(block, pad_width, mode="edge")
+    return block
+
+
+# Reshape the block so that each downsampling window is in the last axis.
+def _to_windows(block, factor):
+    block = _pad_to_factor(block, factor)
+    ndim = block.ndim
+    shape = sum(((sh // factor, factor) for sh in block.shape), ())
+    windows = block.reshape(shape)
+    # Move the window axes (1, 3, 5, ...) to the end and flatten them.
+    windows = windows.transpose(tuple(range(0, 2 * ndim, 2)) + tuple(range(1, 2 * ndim, 2)))
+    return windows.reshape(windows.shape[:ndim] + (-1,))
+
+
+def downsample_mean(block, factor=2):
+    windows = _to_windows(block, factor)
+    mean = windows.mean(axis=-1, dtype="float64")
+    if np.issubdtype(block.dtype, np.integer):
+        mean = np.round(mean)
+    return mean.astype(block.dtype)
+
+
+def downsample_mode(block, factor=2):
+    windows = _to_windows(block, factor)
+    # Count how often each value occurs in its window and select the most frequent one.
+    # (The windows are small, e.g. 4 values in 2D, so comparing all pairs of values is cheap.)
+    counts = (windows[..., :, None] == windows[..., None, :]).sum(axis=-1)
+    index = counts.argmax(axis=-1)[..., None]
+    return np.take_along_axis(windows, index, axis=-1)[..., 0]
+
+
+def _downsample_level(f, group_name, level, factor, is_label, block_shape, n_threads):
+    ds_in = f[f"{group_name}/s{level - 1}"]
+    out_shape = tuple((sh + factor - 1) // factor for sh in ds_in.shape)
+    chunks = tuple(min(bs, sh) for bs, sh in zip(block_shape, out_shape))
+    name = f"{group_name}/s{level}"
+    if name in f:
+        del f[name]
+    ds_out = f.create_dataset(name, shape=out_shape, dtype=ds_in.dtype, chunks=chunks, compression="gzip")
+
+    downsample = downsample_mode if is_label else downsample_mean
+
+    # Process the output block by block, so that we never load the full dataset into memory.
+    def process_block(block_start):
+        bb_out = tuple(slice(start, min(start + bs, sh)) for start, bs, sh in zip(block_start, block_shape, out_shape))
+        bb_in = tuple(slice(b.start * factor, min(b.stop * factor, sh)) for b, sh in zip(bb_out, ds_in.shape))
+        ds_out[bb_out] = downsample(ds_in[bb_in], factor)
+
+    block_starts = list(product(*(range(0, sh, bs) for sh, bs in zip(out_shape, block_shape))))
+    # Note: h5py serializes the reads and writes, but the downsampling runs in parallel.
+    with ThreadPoolExecutor(n_threads) as pool:
+        list(pool.map(process_block, block_starts))
+
+    ds_out.attrs["downsamplingFactors"] = [factor ** level] * ds_in.ndim
+    return ds_out
+
+
+# Write the multiscale metadata, following the layout of the 'multiscales' metadata in OME-NGFF.
+# hdf5 attributes can't store nested dictionaries, so we store it as a json string.
+def _write_metadata(f, group_name, n_scales, factor, ndim, is_label):
+    datasets = [
+        {
+            "path": f"s{level}",
+            "coordinateTransformations": [{"type": "scale", "scale": [float(factor ** level)] * ndim}],
+        }
+        for level in range(n_scales + 1)
+    ]
+    metadata = [{
+        "version": "0.4",
+        "name": group_name,
+        "datasets": datasets,
+        "type": "mode" if is_label else "mean",
+    }]
+    f[group_name].attrs["multiscales"] = json.dumps(metadata)
+
+
+# The default block shape (in the downsampled level). For 3D data we use smaller blocks, because the mode
+# downsampling compares all pairs of values in each window (8 x 8 per output voxel for a factor of 2).
+def _get_block_shape(block_shape, ndim):
+    default = (512,) * ndim if ndim < 3 else (1,) * (ndim - 3) + (16, 256, 256)
+    if block_shape is None:
+        return default
+    if len(block_shape) >= ndim:
+        return tuple(block_shape[-ndim:])
+    # The block shape is given for the last axes, we use the default for the other axes.
+    return default[:ndim - len(block_shape)] + tuple(block_shape)
+
+
+def write_pyramid(path, n_scales=3, factor=2, block_shape=None, n_threads=None):
+    """Write the downsampled levels s1, ..., sN for all raw and label datasets in an hdf5 file.
+
+    :param path: the path to the hdf5 file.
+    :param n_scales: the number of downsampled levels.
+    :param factor: the downsampling factor between consecutive levels.
+    :param block_shape: the shape of the blocks that are processed at once (in the downsampled level).
+        By default 512 x 512 for 2D and 16 x 256 x 256 for 3D data. If it has fewer axes than the data,
+        it is used for the last axes.
+    :param n_threads: the number of threads used for downsampling the blocks.
+    """
+    with h5py.File(path, "a") as f:
+        for group_name in find_multiscale_groups(f):
+            is_label = group_name.startswith("labels")
+            ndim = f[f"{group_name}/s0"].ndim
+            this_block_shape = _get_block_shape(block_shape, ndim)
+            for level in range(1, n_scales + 1):
+                _downsample_level(f, group_name, level, factor, is_label, this_block_shape, n_threads)
+            # Remove the levels of a previous run with more scales, so that they are not mistaken for valid levels.
+            level = n_scales + 1
+            while f"{group_name}/s{level}" in f:
+                del f[f"{group_name}/s{level}"]
+                level += 1
+            _write_metadata(f, group_name, n_scales, factor, ndim, is_label)
+
+
+# Write the pyramids for several files in parallel, using one process per file.
+def write_pyramids(paths, n_scales=3, factor=2, block_shape=None, n_workers=None):
+    n_workers = min(len(paths), os.cpu_count() or 1) if n_workers is None else n_workers
+    with ProcessPoolExecutor(n_workers) as pool:
+        futures = [
+            pool.submit(write_pyramid, path, n_scales, factor, block_shape, n_threads=1) for path in paths
+        ]
+        for future in futures:
+            future.result()
+
+
+# Get all levels of a multiscale group, e.g. for visualizing the data in napari:
+# viewer.add_image(get_pyramid(f, "raw/serum_IgG"), multiscale=True)
+# (The data is read lazily from the hdf5 file, so the file must stay open.)
+# The levels are read from the multiscale metadata. If there is no metadata (e.g. only 's0' exists),
+# we use the consecutive levels s0, s1, ... that exist in the file.
+def get_pyramid(f, group_name):
+    metadata = f[group_name].attrs.get("multiscales", None) if group_name in f else None
+    if metadata is not None:
+        datasets = json.loads(metadata)[0]["datasets"]
+        return [f[f"{group_name}/{dataset['path']}"] for dataset in datasets]
+    levels = []
+    while f"{group_name}/s{len(levels)}" in f:
+        levels.append(f[f"{group_name}/s{len(levels)}"])
+    return levels
+
+
+# Select the highest resolution level that fits into 'max_shape' (per axis) or 'max_size' (number of pixels).
+# Returns the name of the level (e.g. 's1'), which can be read with f[f"{group_name}/{level}"].
+def select_scale(f, group_name, max_shape=None, max_size=None):
+    levels = get_pyramid(f, group_name)
+    if not levels:
+        raise ValueError(f"Could not find any scale levels for {group_name}.")
+    for level, ds in enumerate(levels):
+        fits_shape = max_shape is None or all(sh <= msh for sh, msh in zip(ds.shape, max_shape))
+        fits_size = max_size is None or ds.size <= max_size
+        if fits_shape and fits_size:
+            return f"s{level}"
+    return f"s{len(levels) - 1}"
+
+
+def main(args=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="Write multiscale pyramids for the covid-if hdf5 files.")
+    parser.add_argument("paths", nargs="+", help="The hdf5 files.")
+    parser.add_argument("-n", "--n_scales", type=int, default=3, help="The number of downsampled levels. Default: 3.")
+    parser.add_argument("--factor", type=int, default=2, help="The downsampling factor per level. Default: 2.")
+    parser.add_argument("--n_workers", type=int, default=None, help="The number of files processed in parallel.")
+    args = parser.parse_args(args)
+    write_pyramids(args.paths, n_scales=args.n_scales, factor=args.factor, n_workers=args.n_workers)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,5 @@
+# Make the modules in the root folder of this repository importable in the tests.
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
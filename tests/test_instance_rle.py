@@ -0,0 +1,85 @@
+import json
+
+import numpy as np
+import pytest
+
+from instance_rle import (
+    decode_mask, encode_labels, encode_mask, read_object, read_rle, write_coco, write_rle,
+)
+
+
+def _make_labels(shape, n_objects=20, seed=0):
+    # Random boxes with overlaps, so that objects have holes and are cut off by other objects.
+    rng = np.random.default_rng(seed)
+    labels = np.zeros(shape, dtype="uint32")
+    for label_id in range(1, n_objects + 1):
+        start = [rng.integers(0, sh - 2) for sh in shape]
+        stop = [rng.integers(st + 1, min(st + 12, sh) + 1) for st, sh in zip(start, shape)]
+        labels[tuple(slice(st, sp) for st, sp in zip(start, stop))] = label_id
+    # An object touching the image border along a full axis.
+    labels[:, :2] = n_objects + 1
+    return labels
+
+
+def test_encode_decode_mask():
+    mask = np.array([[1, 0, 1], [1, 1, 0]], dtype=bool)
+    counts = encode_mask(mask)
+    # Column-major order: 1, 1, 0, 1, 1, 0 -> starts with an empty background run.
+    np.testing.assert_array_equal(counts, [0, 2, 1, 2, 1])
+    np.testing.assert_array_equal(decode_mask(counts, mask.shape), mask)
+
+
+@pytest.mark.parametrize("shape", [(64, 80), (12, 40, 36)])
+def test_round_trip(tmp_path, shape):
+    labels = _make_labels(shape)
+    rle = encode_labels(labels)
+    assert set(rle.ids) == set(np.unique(labels)) - {0}
+    np.testing.assert_array_equal(rle.decode(), labels)
+    assert rle.decode().dtype == labels.dtype
+
+    for label_id in rle.ids:
+        bbox, mask = rle.get_object(label_id)
+        np.testing.assert_array_equal(mask, labels[bbox] == label_id)
+
+    path = str(tmp_path / "labels.h5")
+    write_rle(path, rle)
+    np.testing.assert_array_equal(read_rle(path).decode(), labels)
+    for label_id in rle.ids[:5]:
+        bbox, mask = read_object(path, label_id)
+        np.testing.assert_array_equal(mask, labels[bbox] == label_id)
+    with pytest.raises(KeyError):
+        read_object(path, labels.max() + 1)
+
+
+def test_empty_labels():
+    rle = encode_labels(np.zeros((10, 10), dtype="uint16"))
+    assert len(rle) == 0
+    np.testing.assert_array_equal(rle.decode(), np.zeros((10, 10)))
+
+
+def test_coco_annotations(tmp_path):
+    labels = _make_labels((64, 80))
+    rle = encode_labels(labels)
+    annotations = rle.to_coco_annotations()
+    assert len(annotations) == len(rle)
+    for annotation in annotations:
+        segmentation = annotation["segmentation"]
+        assert segmentation["size"] == list(labels.shape)
+        assert sum(segmentation["counts"]) == labels.size
+        # The counts are for the full image, so they decode to the mask of the object in the full image.
+        mask = decode_mask(segmentation["counts"], labels.shape)
+        np.testing.assert_array_equal(mask, labels == annotation["label_id"])
+        assert annotation["area"] == mask.sum()
+        x, y, width, height = annotation["bbox"]
+        ys, xs = np.nonzero(mask)
+        assert (x, y, width, height) == (xs.min(), ys.min(), xs.max() - xs.min() + 1, ys.max() - ys.min() + 1)
+
+    path = tmp_path / "labels.json"
+    write_coco(str(path), rle, file_name="labels.tif")
+    with open(path) as f:
+        coco = json.load(f)
+    assert coco["images"][0]["height"] == 64 and coco["images"][0]["width"] == 80
+    assert len(coco["annotations"]) == len(rle)
+
+    with pytest.raises(ValueError):
+        encode_labels(np.zeros((4, 4, 4), dtype="uint8")).to_coco_annotations()
@@ -0,0 +1,74 @@
+import h5py
+import numpy as np
+import pytest
+
+from intensity_statistics import (
+    GlobalNormalization, compute_dataset_statistics, compute_statistics, get_statistics,
+    read_model_statistics, write_model_statistics,
+)
+
+
+def test_exact_percentiles_uint16():
+    data = np.random.randint(0, 60000, size=(300, 400)).astype("uint16")
+    percentiles = (1.0, 50.0, 99.0)
+    # Small blocks, so that the statistics are accumulated over many blocks.
+    statistics = compute_statistics(data, block_shape=(64, 64), percentiles=percentiles)
+    for q in percentiles:
+        expected = np.percentile(data, q, method="inverted_cdf")
+        assert statistics["percentiles"][str(q)] == expected
+    assert statistics["min"] == data.min()
+    assert statistics["max"] == data.max()
+    assert statistics["count"] == data.size
+    assert statistics["mean"] == pytest.approx(data.mean())
+    assert statistics["std"] == pytest.approx(data.std())
+
+
+def test_float_statistics():
+    data = np.random.normal(5.0, 2.0, size=(20, 100, 100)).astype("float32")
+    statistics = compute_statistics(data, percentiles=(50.0, 99.0))
+    assert statistics["mean"] == pytest.approx(data.mean(), rel=1e-5)
+    assert statistics["std"] == pytest.approx(data.std(), rel=1e-4)
+    # The percentiles of floating point data are approximated with the histogram.
+    value_range = data.max() - data.min()
+    for q in (50.0, 99.0):
+        assert abs(statistics["percentiles"][str(q)] - np.percentile(data, q)) < value_range / 1000
+
+
+def test_statistics_over_several_images(tmp_path):
+    images = [np.random.randint(0, 255, size=(50, 60)).astype("uint8") for _ in range(3)]
+    paths = []
+    for i, image in enumerate(images):
+        paths.append(str(tmp_path / f"image{i}.h5"))
+        with h5py.File(paths[-1], "w") as f:
+            f.create_dataset("raw", data=image)
+    statistics = compute_dataset_statistics(paths, key="raw")
+    assert statistics["mean"] == pytest.approx(np.concatenate(images).mean())
+
+    # The statistics are stored with the data and re-used.
+    statistics = get_statistics(paths[0], key="raw")
+    with h5py.File(paths[0], "a") as f:
+        f["raw"][:] = 0
+    assert get_statistics(paths[0], key="raw") == statistics
+
+
+def test_model_statistics(tmp_path):
+    checkpoint = str(tmp_path / "checkpoints" / "my-model")
+    with pytest.raises(FileNotFoundError):
+        read_model_statistics(checkpoint)
+    statistics = compute_statistics(np.random.rand(32, 32))
+    write_model_statistics(checkpoint, statistics)
+    assert read_model_statistics(checkpoint) == statistics
+
+
+def test_global_normalization():
+    data = np.random.randint(0, 1000, size=(100, 100)).astype("uint16")
+    statistics = compute_statistics(data)
+    normalized = GlobalNormalization(statistics)(data)
+    assert normalized.mean() == pytest.approx(0.0, abs=1e-5)
+    assert normalized.std() == pytest.approx(1.0, abs=1e-5)
+
+    normalized = GlobalNormalization(statistics, mode="percentile", lower=1.0, upper=99.0)(data)
+    assert np.mean(normalized < 0) <= 0.01
+    assert np.mean(normalized > 1) <= 0.01
+    with pytest.raises(ValueError):
+        GlobalNormalization(statistics, mode="percentile", lower=2.0)
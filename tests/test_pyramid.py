@@ -0,0 +1,68 @@
+import h5py
+import numpy as np
+
+from pyramid import downsample_mean, downsample_mode, get_pyramid, select_scale, write_pyramid
+
+
+def test_downsample_mean_odd_shape():
+    block = np.arange(5 * 7, dtype="float32").reshape(5, 7)
+    result = downsample_mean(block, factor=2)
+    assert result.shape == (3, 4)
+    assert result[0, 0] == block[:2, :2].mean()
+    # The last row and column are padded with the edge values.
+    assert result[2, 3] == block[4, 6]
+    assert result[2, 0] == block[4, :2].mean()
+
+
+def test_downsample_mean_integer():
+    block = np.array([[1, 2], [2, 2]], dtype="uint8")
+    result = downsample_mean(block, factor=2)
+    assert result.dtype == np.uint8
+    assert result[0, 0] == 2
+
+
+def test_downsample_mode_odd_shape():
+    block = np.array([
+        [1, 1, 2, 2, 3],
+        [1, 4, 2, 5, 3],
+        [6, 6, 0, 0, 7],
+    ], dtype="uint32")
+    result = downsample_mode(block, factor=2)
+    assert result.shape == (2, 3)
+    assert result.dtype == block.dtype
+    np.testing.assert_array_equal(result, [[1, 2, 3], [6, 0, 7]])
+    # No new label ids are introduced.
+    assert set(np.unique(result)).issubset(set(np.unique(block)))
+
+
+def test_downsample_mode_3d():
+    block = np.zeros((3, 4, 5), dtype="uint16")
+    block[:2, :2, :2] = 9
+    block[0, 0, 0] = 1
+    result = downsample_mode(block, factor=2)
+    assert result.shape == (2, 2, 3)
+    assert result[0, 0, 0] == 9
+
+
+def test_write_pyramid(tmp_path):
+    path = str(tmp_path / "data.h5")
+    raw = np.random.rand(50, 70).astype("float32")
+    labels = np.random.randint(0, 5, size=(50, 70)).astype("uint32")
+    with h5py.File(path, "w") as f:
+        f["raw/serum_IgG/s0"] = raw
+        f["labels/cells/s0"] = labels
+
+    write_pyramid(path, n_scales=3, block_shape=(16, 16))
+    with h5py.File(path, "r") as f:
+        levels = get_pyramid(f, "raw/serum_IgG")
+        assert [level.shape for level in levels] == [(50, 70), (25, 35), (13, 18), (7, 9)]
+        # The blocks are processed independently, so the result must be the same as for the full image.
+        np.testing.assert_allclose(levels[1][:], downsample_mean(raw, 2))
+        np.testing.assert_array_equal(f["labels/cells/s1"][:], downsample_mode(labels, 2))
+        assert select_scale(f, "raw/serum_IgG", max_shape=(30, 40)) == "s1"
+
+    # Levels of a previous run with more scales are removed.
+    write_pyramid(path, n_scales=1)
+    with h5py.File(path, "r") as f:
+        assert len(get_pyramid(f, "raw/serum_IgG")) == 2
+        assert "raw/serum_IgG/s2" not in f
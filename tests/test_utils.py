@@ -0,0 +1,38 @@
+# Check that 'import utils' stays light-weight: the heavy dependencies are only imported
+# inside the functions that need them (see the header of utils.py).
+# Run with: python -m pytest tests
+# The import time is only checked if the environment variable 'CHECK_IMPORT_TIME' is set, because the timing
+# depends on the machine: CHECK_IMPORT_TIME=1 python -m pytest tests
+import os
+import subprocess
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ("torch", "numpy", "h5py", "skimage", "requests", "imageio", "tqdm")
+# The import time budget for utils in microseconds (measured with python -X importtime).
+IMPORT_TIME_BUDGET = 100_000
+
+
+def _run_python(*args):
+    return subprocess.run([sys.executable, *args], cwd=ROOT, capture_output=True, text=True, check=True)
+
+
+def test_import_does_not_load_heavy_modules():
+    check = f"import sys, utils; print([name for name in {HEAVY_MODULES!r} if name in sys.modules])"
+    assert _run_python("-c", check).stdout.strip() == "[]"
+
+
+@pytest.mark.skipif(not os.environ.get("CHECK_IMPORT_TIME"), reason="Set CHECK_IMPORT_TIME to check the import time.")
+def test_import_time():
+    result = _run_python("-X", "importtime", "-c", "import utils")
+    # The lines have the format: "import time: self [us] | cumulative | imported package".
+    for line in result.stderr.splitlines():
+        fields = [field.strip() for field in line.split("|")]
+        if len(fields) == 3 and fields[2] == "utils":
+            cumulative = int(fields[1])
+            break
+    else:
+        raise AssertionError(f"Could not find the import time of utils in:\n{result.stderr}")
+    assert cumulative < IMPORT_TIME_BUDGET, f"Importing utils took {cumulative} us"
@@ -1,19 +1,16 @@
 # General imports.
+# Only light-weight modules from the standard library are imported here.
+# The heavy dependencies (torch, h5py, skimage, requests, imageio, tqdm, numpy) are imported
+# inside the functions that need them, so that 'import utils' stays fast. This matters for
+# the command line interface and for worker processes that only need a few of the functions.
+# You can check the import time with: python -X importtime -c "import utils"
+# This is checked by the tests in tests/test_utils.py (run with: CHECK_IMPORT_TIME=1 python -m pytest tests).
 import os
 import zipfile
 from glob import glob
 from shutil import copyfileobj
 from shutil import move
-import h5py
-from skimage.measure import regionprops
-import requests
-from tqdm import tqdm
-# saving images to tif formats
-import imageio.v3 as imageio
-# from numpyencoder import NumpyEncoder
 import json
-import numpy as np
-import torch
 
 
 # download the data using the requests library
@@ -23,6 +20,8 @@ def download_url(url, path):
     # If the file to be downloaded already exists, quit here.
     if os.path.isfile(path):
         return
+    import requests
+    from tqdm import tqdm
     with requests.get(url, stream=True) as r:
         if r.status_code != 200:
             r.raise_for_status()
@@ -47,6 +46,7 @@ def unzip(zip_path, dst, remove=True):
 # We use a visitor pattern to check out the contents of the file.
 # the 'inspector' function will be called for each element in the file hierarchy.
 def inspector(name, node):
+    import h5py
     # hdf5 files contain 'Dataset' that hold the actual data. With the function below we print
     # the name and shape if the inspector function encounters a dataset
     if isinstance(node, h5py.Dataset):
@@ -55,6 +55,7 @@ def inspector(name, node):
 
 class CustomEncoder(json.JSONEncoder):
     def default(self, obj):
+        import numpy as np
         if isinstance(obj, np.ndarray):
             return obj.tolist()
         elif isinstance(obj, np.int64):
@@ -68,6 +69,11 @@ class CustomEncoder(json.JSONEncoder):
 # extract 5 images from 1 hd5 file and
 # put them in a designated directory
 def convert_hdf5_to_tif(paths, file_folders, data_folder):
+    import h5py
+    # saving images to tif formats
+    import imageio.v3 as imageio
+    from skimage.measure import regionprops
+    from tqdm import tqdm
     count = 0
     for file_path in tqdm(paths):
         with h5py.File(file_path, 'r') as f:
@@ -169,6 +175,7 @@ def flatten_samples(input_):
 # This function computes the Dice similarity coefficient between the predicted input and the target. 
 # It's commonly used in evaluating the performance of segmentation models.
 def dice_score(input_, target, eps=1e-7):
+    import torch
     assert input_.shape == target.shape, f"{input_.shape}, {target.shape}"
     # Flatten input and target to have the shape (C, N),
     # where N is the number of samples
@@ -211,5 +218,22 @@ def prepare_data(data_folder="data", remove_h5=True):
     print("We have", len(os.listdir(test_folder)), "test images in", test_folder)
 
 
+# command line interface for the data preparation, run it via
+# python -m utils --data_folder data
+def main(args=None):
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Download the covid-if data and prepare the train, val and test splits."
+    )
+    parser.add_argument(
+        "-d", "--data_folder", default="data", help="The folder for saving the data. Default: 'data'."
+    )
+    parser.add_argument(
+        "--keep_h5", action="store_true", help="Keep the h5 files after converting them to tif."
+    )
+    args = parser.parse_args(args)
+    prepare_data(data_folder=args.data_folder, remove_h5=not args.keep_h5)
+
+
 if __name__ == "__main__":
-    prepare_data()
+    main()